@@ -7,7 +7,6 @@ import json
 import yaml
 
 from urllib.parse import urlencode
-import requests
 
 from ansible.constants import DEFAULT_VAULT_ID_MATCH
 from ansible.parsing.vault import VaultLib
@@ -21,20 +20,20 @@ from interfaces import load_chassis_interfaces as chassis_interface_load
 
 VAULT_FILE = os.path.join(os.path.dirname(__file__), "../inventories/production/group_vars/all/vault.yml")
 VAULT_PASSWORD_FILE = os.path.join(os.path.dirname(__file__), "../.secrets/vault-pass.txt")
+INVENTORYDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../inventories/production")
+sys.path.append(INVENTORYDIR)
+
+from netbox import NetBoxSession
 
 
 class NetBoxClient:
   def __init__(self, netbox_url, netbox_api_token):
     self.api_endpoint = netbox_url.rstrip("/") + "/api"
     self.token = netbox_api_token
+    self.session = NetBoxSession(netbox_api_token)
 
 
   def query(self, request_path, data=None, update=False):
-    headers = {
-      "Authorization": f"Token {self.token}",
-      "Content-Type": "application/json",
-      "Accept": "application/json; indent=4"
-    }
     responses = []
     url = self.api_endpoint + request_path
 
@@ -44,15 +43,15 @@ class NetBoxClient:
         d = data[cnt:cnt+limit]
         raw = None
         if update:
-          raw = requests.patch(url, json.dumps(d), headers=headers, verify=True)
+          raw = self.session.patch(url, json.dumps(d), verify=True)
         else:
-          raw = requests.post(url, json.dumps(d), headers=headers, verify=True)
+          raw = self.session.post(url, json.dumps(d), verify=True)
         responses += json.loads(raw.text)
         cnt += limit
 
     else:
       while url:
-        raw = requests.get(url, headers=headers, verify=True)
+        raw = self.session.get(url, verify=True)
         res = json.loads(raw.text)
         responses += res["results"]
         url = res["next"]
@@ -892,6 +891,8 @@ def main():
   #if res:
   #  pprint(res)
 
+  print("NetBox:", nb.session.report())
+
 
 def develop():
   secrets = __load_encrypted_secrets()
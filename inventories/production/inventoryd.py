@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# This file is part of Ansible.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import contextlib
+import hashlib
+import hmac
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+
+from netbox import CHANGED_GROUP, NETBOX_SOCKET, NETBOX_VLAN_CATALOG
+from netbox import DevConfig, NetBoxClient
+from netbox import changed_hosts, inventory_vars, iter_hostvars, match_limit, netbox_credentials, parse_limit, timestamp
+
+## Snapshots are required by the delta sync, so the daemon always keeps them. They are its own: a snapshot written
+## by another run would hide the changes since from the next sync.
+CACHE_DIR = os.getenv("NETBOX_DAEMON_CACHE_DIR", os.path.join(os.path.dirname(__file__), "../../.cache/inventoryd"))
+WEBHOOK_ADDRESS = os.getenv("NETBOX_WEBHOOK", "127.0.0.1:8765")  # Empty to disable
+WEBHOOK_SECRET = os.getenv("NETBOX_WEBHOOK_SECRET")  # Same as the secret of the webhook in NetBox, if any
+WEBHOOK_MODELS = ["site", "vlan", "device", "interface"]
+
+
+class InventoryService:
+  def __init__(self, netbox_url, netbox_api_token, cache_dir=CACHE_DIR):
+    self.nb = NetBoxClient(netbox_url, netbox_api_token, cache_dir=cache_dir)
+    self.cf = DevConfig(self.nb)
+    self.devices = []
+    self.hostvars = {}
+    self.vars = None
+    self.__lock = threading.Lock()
+    self.__pending = threading.Event()
+    self.__build()
+
+
+  ## Requests keep being served from the previous inventory until the rebuilt one is swapped in. Hosts are built in
+  ## this process: forking workers alongside the server threads may deadlock the children on a lock held by a thread.
+  def __build(self, dirty=None):
+    devices = self.cf.get_all_devices()
+    stale = [d for d in devices if dirty is None or d["hostname"] in dirty or d["hostname"] not in self.hostvars]
+    rebuilt = dict(zip([d["hostname"] for d in stale], iter_hostvars(self.cf, stale, None, workers=1)))
+    hostvars = {h: rebuilt[h] if h in rebuilt else self.hostvars[h] for h in [d["hostname"] for d in devices]}
+    all_vars = inventory_vars(self.cf) if NETBOX_VLAN_CATALOG else None
+    with self.__lock:
+      self.devices, self.hostvars, self.vars = devices, hostvars, all_vars
+    return len(stale)
+
+
+  def inventory(self, limit=None):
+    ts = timestamp()
+    limit = parse_limit(limit)
+    with self.__lock:
+      devices, hostvars, all_vars = self.devices, self.hostvars, self.vars
+
+    inventory = {
+      "_meta": {
+        "hostvars": {}
+      }
+    }
+
+    for device in devices:
+      hostname = device["hostname"]
+      group = device["role"].upper()
+      if limit is not None and not match_limit(limit, ["all", hostname, group, device["region"]]):
+        continue
+      try:
+        inventory[group]["hosts"].append(hostname)
+      except KeyError:
+        inventory[group] = {"hosts": [hostname]}
+      inventory["_meta"]["hostvars"][hostname] = {**hostvars[hostname], "datetime": ts}
+
+    ## Compared on every request, as the playbooks record the hashes behind the daemon
+    inventory[CHANGED_GROUP] = {"hosts": changed_hosts(inventory["_meta"]["hostvars"])}
+    if all_vars is not None:
+      inventory["all"] = {"vars": all_vars}
+    return inventory
+
+
+  def host(self, hostname):
+    with self.__lock:
+      hostvars = self.hostvars.get(hostname)
+    if hostvars is None:
+      return {}
+    return {**hostvars, "datetime": timestamp()}
+
+
+  def invalidate(self):
+    self.__pending.set()
+
+
+  ## Events arriving within the debounce period are coalesced into one delta sync. A failed refresh may leave the
+  ## objects half-loaded, so every host is rebuilt once the next one succeeds.
+  def run(self, debounce=1.0, interval=600):
+    failed = False
+    while True:
+      self.__pending.wait(timeout=interval or None)
+      time.sleep(debounce)
+      self.__pending.clear()
+      start_at = time.time()
+      try:
+        dirty = self.cf.refresh(self.nb)
+      except Exception as e:
+        print("Failed to refresh the inventory, retrying later:", e, file=sys.stderr)
+        failed = True
+        continue
+      if failed:
+        dirty, failed = None, False
+      n_rebuilt = self.__build(dirty)
+      elapsed_time = round(time.time() - start_at, 2)
+      hostnames = ", ".join(sorted(dirty)) if dirty is not None else "all hosts"
+      print(f"Refreshed {n_rebuilt} hosts ({elapsed_time}sec): {hostnames}", file=sys.stderr, flush=True)
+
+
+class InventoryRequestHandler(socketserver.StreamRequestHandler):
+  def handle(self):
+    try:
+      request = json.loads(self.rfile.readline())
+    except ValueError:
+      return
+    service = self.server.service
+    if request.get("host") is not None:
+      response = service.host(request["host"])
+    else:
+      response = service.inventory(request.get("limit"))
+    self.wfile.write(json.dumps(response).encode())
+
+
+class InventorySocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+
+  def __init__(self, socket_path, service):
+    if os.path.exists(socket_path):
+      os.unlink(socket_path)  # Left behind by a previous daemon
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+    super().__init__(socket_path, InventoryRequestHandler)
+    os.chmod(socket_path, 0o600)
+    self.service = service
+
+
+## Receives the webhooks of NetBox: https://docs.netbox.dev/en/stable/integrations/webhooks/
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+    if WEBHOOK_SECRET:
+      signature = hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha512).hexdigest()
+      if not hmac.compare_digest(signature, self.headers.get("X-Hook-Signature", "")):
+        return self.__reply(403)
+    try:
+      event = json.loads(body)
+    except ValueError:
+      return self.__reply(400)
+    if event.get("model") in WEBHOOK_MODELS:
+      self.server.service.invalidate()
+    self.__reply(202)
+
+
+  def __reply(self, status):
+    self.send_response(status)
+    self.send_header("Content-Length", "0")
+    self.end_headers()
+
+
+  def log_message(self, format, *args):
+    pass
+
+
+def serve_in_background(server):
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  return thread
+
+
+def main():
+  parser = argparse.ArgumentParser(description="serve the dynamic inventory from memory, refreshed by NetBox webhooks")
+  parser.add_argument("-s", "--socket", dest="PATH", default=NETBOX_SOCKET, help="path of the unix socket netbox.py connects to")
+  parser.add_argument("-w", "--webhook", dest="ADDRESS", default=WEBHOOK_ADDRESS, help="address receiving the webhooks (e.g., 0.0.0.0:8765)")
+  parser.add_argument("--debounce", type=float, default=1.0, help="seconds to wait for more events before refreshing")
+  parser.add_argument("--interval", type=float, default=600, help="seconds between refreshes without any event, 0 to disable")
+  args = parser.parse_args()
+
+  start_at = time.time()
+  netbox_url, netbox_api_token = netbox_credentials()
+  service = InventoryService(netbox_url, netbox_api_token)
+  elapsed_time = round(time.time() - start_at, 1)
+  print(f"Loaded {len(service.hostvars)} hosts from {netbox_url} ({elapsed_time}sec)", file=sys.stderr, flush=True)
+
+  socket_server = InventorySocketServer(args.PATH, service)
+  serve_in_background(socket_server)
+  print(f"Serving the inventory on {args.PATH}", file=sys.stderr, flush=True)
+
+  if args.ADDRESS:
+    host, port = args.ADDRESS.rsplit(":", 1)
+    webhook_server = ThreadingHTTPServer((host, int(port)), WebhookRequestHandler)
+    webhook_server.service = service
+    serve_in_background(webhook_server)
+    print(f"Waiting for the webhooks on http://{args.ADDRESS}/", file=sys.stderr, flush=True)
+
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # Remove the socket on "kill" as well
+  try:
+    service.run(debounce=args.debounce, interval=args.interval)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    socket_server.server_close()
+    with contextlib.suppress(FileNotFoundError):
+      os.unlink(args.PATH)
+
+
+if __name__ == "__main__":
+  main()
@@ -1,15 +1,34 @@
 #!/usr/bin/env python3
 # This file is part of Ansible.
 
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
 from pprint import pprint
 from datetime import datetime
+import argparse
+import hashlib
 import json
+import multiprocessing
 import os
+import pickle
 import re
 import requests
+import socket
 import sys
+import tempfile
+import threading
+import time
 import yaml
 
+try:
+  import orjson  # Optional, several times faster than json
+except ImportError:
+  orjson = None
+
+from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 from ansible.constants import DEFAULT_VAULT_ID_MATCH
 from ansible.parsing.vault import VaultLib
 from ansible.parsing.vault import VaultSecret
@@ -18,64 +37,506 @@ from ansible.parsing.vault import AnsibleVaultError
 VAULT_FILE = os.path.join(os.path.dirname(__file__), "./group_vars/all/vault.yml")
 VAULT_PASSWORD_FILE = os.path.join(os.path.dirname(__file__), "../../.secrets/vault-pass.txt")
 
+NETBOX_URL = os.getenv("NETBOX_URL")  # Overrides the vault, e.g., with a local stand-in for testing
+NETBOX_API_TOKEN = os.getenv("NETBOX_API_TOKEN", "")
+NETBOX_SOCKET = os.getenv("NETBOX_SOCKET", os.path.join(os.path.dirname(__file__), "../../.cache/inventory.sock"))
+NETBOX_PAGE_SIZE = int(os.getenv("NETBOX_PAGE_SIZE", 1000))
+NETBOX_MAX_WORKERS = int(os.getenv("NETBOX_MAX_WORKERS", 8))
+NETBOX_TIMEOUT = float(os.getenv("NETBOX_TIMEOUT", 60))
+NETBOX_RETRIES = int(os.getenv("NETBOX_RETRIES", 3))
+NETBOX_BACKOFF = float(os.getenv("NETBOX_BACKOFF", 0.5))
+NETBOX_STATS = os.getenv("NETBOX_STATS", "") not in ["", "0"]
+NETBOX_CACHE_DIR = os.getenv("NETBOX_CACHE_DIR")  # Snapshot cache is disabled unless specified
+NETBOX_CACHE_TTL = float(os.getenv("NETBOX_CACHE_TTL", 3600))
+NETBOX_REFRESH = os.getenv("NETBOX_REFRESH", "") not in ["", "0"]
+NETBOX_DELTA = os.getenv("NETBOX_DELTA", "") not in ["", "0"]
+NETBOX_FIELDS = os.getenv("NETBOX_FIELDS", "") not in ["", "0"]  # Honored by NetBox v4.0 or later, ignored before
+NETBOX_BUILD_WORKERS = int(os.getenv("NETBOX_BUILD_WORKERS", 1))  # Processes building the hostvars; 0 for all cores
+NETBOX_VLAN_CATALOG = os.getenv("NETBOX_VLAN_CATALOG", "") not in ["", "0"]  # Share VLANs through the group vars of "all"
+NETBOX_LIMIT = os.getenv("NETBOX_LIMIT")  # Same pattern as "ansible-playbook --limit"; Ansible never passes it to us
+NETBOX_INTENT_DIR = os.getenv("NETBOX_INTENT_DIR", os.path.join(os.path.dirname(__file__), "../../backup/intents"))
+
+ROLES_DIR = os.path.join(os.path.dirname(__file__), "../../roles")
+CHANGED_GROUP = "CHANGED"
+
+
+class NetBoxSession(requests.Session):
+  def __init__(self, netbox_api_token, pool_size=NETBOX_MAX_WORKERS, timeout=NETBOX_TIMEOUT,
+               retries=NETBOX_RETRIES, backoff=NETBOX_BACKOFF):
+    super().__init__()
+    self.timeout = timeout
+    self.headers.update({
+      "Authorization":   f"Token {netbox_api_token}",
+      "Content-Type":    "application/json",
+      "Accept":          "application/json",  # No "indent=4": NetBox would pretty-print every response
+      "Accept-Encoding": "gzip",
+    })
+
+    ## Only idempotent methods are retried on 5xx, so bulk POSTs never get duplicated
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[429, 500, 502, 503, 504])
+    ## Blocking pool: the number of requests in flight never exceeds the pool size, however many threads ask
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(pool_size, 1), pool_block=True, max_retries=retry)
+    self.mount("http://", adapter)
+    self.mount("https://", adapter)
+
+    self.__lock = threading.Lock()
+    self.n_requests = 0
+    self.wire_bytes = 0
+    self.content_bytes = 0
+
+
+  def request(self, method, url, **kwargs):
+    kwargs.setdefault("timeout", self.timeout)
+    res = super().request(method, url, **kwargs)
+    with self.__lock:
+      self.n_requests += 1
+      self.wire_bytes += res.raw.tell()  # Compressed size as received from the socket
+      self.content_bytes += len(res.content)
+    return res
+
+
+  def report(self):
+    n_connections = 0
+    for adapter in set(self.adapters.values()):
+      pools = adapter.poolmanager.pools
+      for key in pools.keys():
+        n_connections += pools[key].num_connections
+    n_reused = self.n_requests - n_connections
+    return (f"{self.n_requests} requests over {n_connections} connections ({n_reused} reused), "
+            f"{self.wire_bytes} bytes transferred ({self.content_bytes} bytes decoded)")
+
+
+class NetBoxSnapshot:
+  def __init__(self, cache_dir, netbox_url, ttl=NETBOX_CACHE_TTL):
+    self.cache_dir = cache_dir
+    self.netbox_url = netbox_url.rstrip("/")
+    self.ttl = ttl
+
+
+  def __path(self, request_path):
+    key = hashlib.sha256(f"{self.netbox_url} {request_path}".encode()).hexdigest()
+    return os.path.join(self.cache_dir, f"{key[:32]}.pickle")
+
+
+  def load(self, request_path):
+    try:
+      with open(self.__path(request_path), "rb") as fd:
+        snapshot = pickle.load(fd)
+    except (OSError, EOFError, AttributeError, pickle.UnpicklingError):  # AttributeError: records of an old layout
+      return None
+    if snapshot.get("url") != self.netbox_url or snapshot.get("path") != request_path:
+      return None
+    if snapshot.get("record") is not None:
+      cls = RECORD_CLASSES.get(snapshot["record"])
+      if cls is None:
+        return None
+      snapshot["objects"] = [cls(*values) for values in snapshot["objects"]]
+    return snapshot
+
+
+  def is_fresh(self, snapshot):
+    return time.time() - snapshot["fetched_at"] < self.ttl
+
+
+  def save(self, request_path, objects, **meta):
+    snapshot = {
+      "url":        self.netbox_url,
+      "path":       request_path,
+      "fetched_at": time.time(),
+      "objects":    objects,
+      **meta,
+    }
+    stored = snapshot
+    if objects and isinstance(objects[0], Record):
+      stored = {**snapshot, "record": type(objects[0]).__name__, "objects": [o.astuple() for o in objects]}
+
+    os.makedirs(self.cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+    try:
+      with os.fdopen(fd, "wb") as f:
+        pickle.dump(stored, f, protocol=pickle.HIGHEST_PROTOCOL)
+      os.replace(tmp_path, self.__path(request_path))  # Concurrent readers never see a partial snapshot
+    except BaseException:
+      os.unlink(tmp_path)
+      raise
+    return snapshot
+
 
 class NetBoxClient:
-  def __init__(self, netbox_url, netbox_api_token):
+  def __init__(self, netbox_url, netbox_api_token, page_size=NETBOX_PAGE_SIZE, max_workers=NETBOX_MAX_WORKERS,
+               cache_dir=NETBOX_CACHE_DIR, cache_ttl=NETBOX_CACHE_TTL, refresh=NETBOX_REFRESH, delta=NETBOX_DELTA,
+               fields=NETBOX_FIELDS):
     self.api_endpoint = netbox_url.rstrip("/") + "/api"
     self.token = netbox_api_token
+    self.page_size = page_size
+    self.max_workers = max_workers
+    self.session = NetBoxSession(netbox_api_token, pool_size=max_workers)
+    self.snapshot = None
+    if cache_dir:
+      self.snapshot = NetBoxSnapshot(cache_dir, netbox_url, ttl=cache_ttl)
+    self.refresh = refresh
+    self.delta = delta
+    self.fields = fields
+    self.changes = {}  # {"interfaces": (updated_ids, deleted_ids)}, or None when everything was fetched again
+    self.__changes = {}
     self.all_sites = []
     self.all_vlans = []
     self.all_devices = []
     self.all_interfaces = []
 
 
-  def query(self, request_path):
+  def __get(self, url):
+    raw = self.session.get(url, verify=True)
+    return json.loads(raw.text)
+
+
+  def query(self, request_path, parallel=True, sync=False, projection=None, on_page=None):
+    self.__changes[request_path] = None
+    if self.snapshot is None:
+      return self.fetch(request_path, parallel=parallel, projection=projection, on_page=on_page)
+
+    snapshot = None
+    if not self.refresh:
+      snapshot = self.snapshot.load(request_path)
+      if snapshot is not None and snapshot.get("projection") != projection_key(projection):
+        snapshot = None  # Taken with other fields
+      if snapshot is not None and self.snapshot.is_fresh(snapshot) and not sync:
+        self.__changes[request_path] = (set(), set())
+        if on_page is not None:
+          on_page(snapshot["objects"])
+        return snapshot["objects"]
+
+    if snapshot is not None and snapshot.get("last_updated") and (self.delta or sync):
+      responses = self.__sync(request_path, snapshot, projection)
+      if on_page is not None:
+        on_page(responses)
+    else:
+      responses = self.fetch(request_path, parallel=parallel, projection=projection, on_page=on_page)
+    self.snapshot.save(request_path, responses, last_updated=latest_update(responses),
+                       projection=projection_key(projection))
+    return responses
+
+
+  def __sync(self, request_path, snapshot, projection):
+    sep = "&" if "?" in request_path else "?"
+    since = urlencode({"last_updated__gte": snapshot["last_updated"]})
+    updated = self.fetch(f"{request_path}{sep}{since}", projection=projection)
+    ids = [o["id"] for o in self.fetch(f"{request_path}{sep}brief=1")]  # Cheap listing to detect deletions
+
+    objects = {o["id"]: o for o in snapshot["objects"]}
+    updated_ids = {o["id"] for o in updated if objects.get(o["id"]) != o}
+    objects.update({o["id"]: o for o in updated})
+
+    ## Objects which newly match the request without being modified, e.g., interfaces of a newly added device
+    missing_ids = [i for i in ids if i not in objects]
+    for n in range(0, len(missing_ids), 100):
+      id_filter = urlencode({"id": missing_ids[n:n+100]}, doseq=True)
+      objects.update({o["id"]: o for o in self.fetch(f"{request_path}{sep}{id_filter}", projection=projection)})
+    updated_ids |= set(missing_ids)
+
+    deleted_ids = set(objects) - set(ids)
+    self.__changes[request_path] = (updated_ids, deleted_ids)
+    return [objects[i] for i in ids if i in objects]
+
+
+  def query_many(self, request_paths, sync=False, projection=None, on_page=None):
+    if len(request_paths) == 1:
+      return self.query(request_paths[0], sync=sync, projection=projection, on_page=on_page)
+
+    ## Each request is handed over to on_page in order once it and all its predecessors have completed
+    results = []
+    with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+      query = lambda request_path: self.query(request_path, sync=sync, projection=projection)
+      for responses in executor.map(query, request_paths):
+        if on_page is not None:
+          on_page(responses)
+        results += responses
+    return results
+
+
+  def get_changes(self, *request_paths):
+    updated_ids, deleted_ids = set(), set()
+    for request_path in request_paths:
+      changes = self.__changes.get(request_path)
+      if changes is None:
+        return None
+      updated_ids |= changes[0]
+      deleted_ids |= changes[1]
+    return updated_ids, deleted_ids
+
+
+  def fetch(self, request_path, parallel=True, projection=None, on_page=None):
     responses = []
+    def receive(res):
+      page = project(res["results"], projection)
+      if on_page is not None:
+        on_page(page)
+      responses.extend(page)
+
+    sep = "&" if "?" in request_path else "?"
+    if projection is not None and self.fields:
+      request_path += sep + urlencode({"fields": ",".join(projection_fields(projection))})
+      sep = "&"
     url = self.api_endpoint + request_path
-    headers = {
-      "Authorization": f"Token {self.token}",
-      "Content-Type":  "application/json",
-      "Accept":        "application/json; indent=4"
-    }
 
-    while url:
-      raw = requests.get(url, headers=headers, verify=True)
-      res = json.loads(raw.text)
-      responses += res["results"]
-      url = res["next"]
+    ## Unused keys are dropped page by page, so that the full objects never pile up in memory
+    if not parallel or self.max_workers < 2:
+      while url:
+        res = self.__get(url)
+        receive(res)
+        url = res["next"]
+      return responses
+
+    ## Read the total count from the first page, then fetch the remaining offset/limit windows concurrently.
+    ## NetBox silently caps the limit at MAX_PAGE_SIZE, so the actual size of the first page is the stride.
+    page_url = lambda offset, limit: f"{url}{sep}limit={limit}&offset={offset}"
+    res = self.__get(page_url(0, self.page_size))
+    receive(res)
+    stride = len(res["results"])
+    if stride == 0 or res["next"] is None:
+      return responses
+
+    offsets = range(stride, res["count"], stride)
+    with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+      for res in executor.map(lambda offset: self.__get(page_url(offset, stride)), offsets):
+        receive(res)
     return responses
 
 
-  def get_all_sites(self, use_cache=True):
+  def get_all_sites(self, use_cache=True, sync=False, params=None, projection=None):
     if not use_cache or not self.all_sites:
-      self.all_sites = self.query("/dcim/sites/")
+      request_path = with_params("/dcim/sites/", params)
+      self.all_sites = self.query(request_path, sync=sync, projection=projection)
+      self.changes["sites"] = self.get_changes(request_path)
     return self.all_sites
 
 
-  def get_all_vlans(self, use_cache=True):
+  def get_all_vlans(self, use_cache=True, sync=False, params=None, projection=None):
     if not use_cache or not self.all_vlans:
-      self.all_vlans = self.query("/ipam/vlans/")
-      for vlan in self.all_vlans:
-        vlan["tags"] = [tag["slug"] for tag in vlan["tags"]]
+      request_path = with_params("/ipam/vlans/", params)
+      self.all_vlans = self.query(request_path, sync=sync, projection=projection)
+      self.changes["vlans"] = self.get_changes(request_path)
+      if projection is None:  # Otherwise the projection is responsible for flattening tags
+        for vlan in self.all_vlans:
+          vlan["tags"] = [tag["slug"] for tag in vlan["tags"]]
     return self.all_vlans
 
 
-  def get_all_devices(self, use_cache=True):
+  def get_all_devices(self, use_cache=True, sync=False, params=None, projection=None):
     if not use_cache or not self.all_devices:
-      self.all_devices = self.query("/dcim/devices/")
-      for device in self.all_devices:
-        device["tags"] = [tag["slug"] for tag in device["tags"]]
+      request_path = with_params("/dcim/devices/", params)
+      self.all_devices = self.query(request_path, sync=sync, projection=projection)
+      self.changes["devices"] = self.get_changes(request_path)
+      if projection is None:
+        for device in self.all_devices:
+          device["tags"] = [tag["slug"] for tag in device["tags"]]
     return self.all_devices
 
 
-  def get_all_interfaces(self, use_cache=True):
-    if not use_cache or not self.all_interfaces:
-      self.all_interfaces = self.query("/dcim/interfaces/")
-      for interface in self.all_interfaces:
-        interface["tags"] = [tag["slug"] for tag in interface["tags"]]
+  def get_brief_devices(self, params, sync=False):
+    return self.query(with_params("/dcim/devices/", {**params, "brief": 1}), sync=sync)
+
+
+  def get_all_interfaces(self, use_cache=True, sync=False, device_ids=None, projection=None, on_page=None):
+    if use_cache and self.all_interfaces:
+      if on_page is not None:
+        on_page(self.all_interfaces)
+    else:
+      request_paths = ["/dcim/interfaces/"]
+      if device_ids is not None:
+        ## Keep URLs short; sorting keeps the chunks, and hence their snapshots, stable across runs
+        device_ids = sorted(device_ids)
+        request_paths = [
+          with_params("/dcim/interfaces/", {"device_id": device_ids[n:n+50]}) for n in range(0, len(device_ids), 50)
+        ]
+      self.all_interfaces = self.query_many(request_paths, sync=sync, projection=projection, on_page=on_page)
+      self.changes["interfaces"] = self.get_changes(*request_paths)
+      if projection is None:
+        for interface in self.all_interfaces:
+          interface["tags"] = [tag["slug"] for tag in interface["tags"]]
     return self.all_interfaces
 
 
+def with_params(request_path, params=None):
+  if not params:
+    return request_path
+  return request_path + "?" + urlencode(params, doseq=True)
+
+
+## Projection spec: {key: None} keeps the value as it is, {key: {...}} projects the nested object or list of objects,
+## and {key: "subkey"} replaces the nested object(s) with the value of the subkey, e.g., tags with their slugs.
+## A Record class as the spec turns each object into a record.
+def project(obj, projection):
+  if obj is None or projection is None:
+    return obj
+  if isinstance(obj, list):
+    return [project(o, projection) for o in obj]
+  if isinstance(projection, type):
+    return projection.from_netbox(obj)
+  if isinstance(projection, str):
+    return obj[projection]
+  return {k: project(obj[k], sub) for k, sub in projection.items() if k in obj}
+
+
+## Snapshots remember what they were projected with; records are identified by their layout
+def projection_key(projection):
+  if isinstance(projection, type):
+    return projection.__name__, projection.__slots__
+  return projection
+
+
+## Top-level keys to request from NetBox for the projection
+def projection_fields(projection):
+  if isinstance(projection, type):
+    return projection.NETBOX_FIELDS
+  return list(projection)
+
+
+## Complement of the vids within the valid VLAN range as range strings, e.g., [10, 20] -> ["1-9", "11-19", "21-4094"]
+def removed_vid_ranges(vids, first=1, last=4094):
+  ranges, lower = [], first
+  for vid in sorted(set(vids)):
+    if vid < lower or vid > last:
+      continue
+    if vid > lower:
+      ranges.append(f"{lower}-{vid-1}" if vid - 1 > lower else str(lower))
+    lower = vid + 1
+  if lower <= last:
+    ranges.append(f"{lower}-{last}" if last > lower else str(lower))
+  return ranges
+
+
+def latest_update(objects):
+  stamps = [o["last_updated"] for o in objects if o.get("last_updated")]
+  if not stamps:
+    return None
+  return max(stamps, key=lambda s: datetime.fromisoformat(s.replace("Z", "+00:00")))
+
+
+## Limit hint in the syntax of "ansible-playbook --limit": hostnames, groups (e.g., EDGE-SW) or regions with wildcards,
+## separated by commas or colons, and "!" to exclude. Patterns it cannot evaluate ("&", "~" and "@", or the CHANGED group
+## known only after building) disable the hint, so that it never drops a host Ansible would target.
+def parse_limit(limit):
+  if not limit:
+    return None
+  patterns = [p.strip() for p in re.split("[,:]", limit) if p.strip()]
+  if not patterns or any(p[0] in "&~@" or p.lstrip("!") == CHANGED_GROUP for p in patterns):
+    return None
+  includes = [p for p in patterns if p[0] != "!"]
+  excludes = [p[1:] for p in patterns if p[0] == "!"]
+  return includes or ["all"], excludes
+
+
+def match_limit(limit, names):
+  includes, excludes = limit
+  matches = lambda patterns: any(fnmatchcase(name, p) for p in patterns for name in names if name is not None)
+  return matches(includes) and not matches(excludes)
+
+
+## Tag slugs, types and names repeat across thousands of objects: each distinct string or tag set is kept once
+INTERNED_TAGS = {}
+
+
+def interned(value):
+  return sys.intern(value) if isinstance(value, str) else value
+
+
+def interned_tags(tags):
+  slugs = tuple(sys.intern(tag["slug"]) for tag in tags)
+  return INTERNED_TAGS.setdefault(slugs, slugs)
+
+
+def nested(obj, key, subkey):
+  value = obj.get(key)
+  return interned(value[subkey]) if value is not None else None
+
+
+## Flat, slotted copy of a NetBox object holding only what the inventory needs.
+## Records can be read by key like the objects they replace, which the snapshot delta sync relies on.
+class Record:
+  __slots__ = ()
+  NETBOX_FIELDS = []
+
+
+  def __init__(self, *values):
+    for key, value in zip(self.__slots__, values):
+      setattr(self, key, value)
+
+
+  def __getitem__(self, key):
+    return getattr(self, key)
+
+
+  def get(self, key, default=None):
+    return getattr(self, key, default)
+
+
+  def __eq__(self, other):
+    return type(self) is type(other) and all(getattr(self, k) == getattr(other, k) for k in self.__slots__)
+
+
+  ## Snapshots hold records as plain tuples along with the class name: pickling the class itself would tie them to
+  ## the module name, which is "__main__" when this file runs as a script
+  def astuple(self):
+    return tuple(getattr(self, k) for k in self.__slots__)
+
+
+  def __repr__(self):
+    values = ", ".join(f"{k}={getattr(self, k)!r}" for k in self.__slots__)
+    return f"{self.__class__.__name__}({values})"
+
+
+class Vlan(Record):
+  __slots__ = ("id", "last_updated", "vid", "name", "description", "tags", "group")
+  NETBOX_FIELDS = ["id", "last_updated", "vid", "name", "description", "tags", "group"]
+
+
+  @classmethod
+  def from_netbox(cls, obj):
+    return cls(
+      obj["id"], obj.get("last_updated"), obj["vid"], interned(obj["name"]), interned(obj["description"]),
+      interned_tags(obj["tags"]), nested(obj, "group", "slug"),
+    )
+
+
+class Device(Record):
+  __slots__ = ("id", "last_updated", "name", "status", "tags", "primary_ip", "role", "site", "manufacturer")
+  NETBOX_FIELDS = ["id", "last_updated", "name", "status", "tags", "primary_ip", "role", "device_role", "site",
+                   "device_type"]
+
+
+  ## NetBox v4.0 renamed "device_role" to "role"; v3.6 and later send both
+  @classmethod
+  def from_netbox(cls, obj):
+    role = nested(obj, "role", "slug") if obj.get("role") is not None else nested(obj, "device_role", "slug")
+    return cls(
+      obj["id"], obj.get("last_updated"), interned(obj["name"]), nested(obj, "status", "value"),
+      interned_tags(obj["tags"]), nested(obj, "primary_ip", "address"), role,
+      nested(obj, "site", "slug"), interned(obj["device_type"]["manufacturer"]["slug"]),
+    )
+
+
+class Interface(Record):
+  __slots__ = ("id", "last_updated", "name", "device", "type", "tags", "mode", "untagged_vid", "tagged_vids", "lag",
+               "enabled", "description")
+  NETBOX_FIELDS = ["id", "last_updated", "name", "device", "type", "tags", "mode", "untagged_vlan", "tagged_vlans",
+                   "lag", "enabled", "description"]
+
+
+  @classmethod
+  def from_netbox(cls, obj):
+    return cls(
+      obj["id"], obj.get("last_updated"), interned(obj["name"]), nested(obj, "device", "name"),
+      nested(obj, "type", "value"), interned_tags(obj["tags"]), nested(obj, "mode", "value"),
+      obj["untagged_vlan"]["vid"] if obj.get("untagged_vlan") is not None else None,
+      tuple(vlan["vid"] for vlan in obj.get("tagged_vlans") or []), nested(obj, "lag", "name"), obj["enabled"],
+      interned(obj["description"]),
+    )
+
+
+RECORD_CLASSES = {cls.__name__: cls for cls in [Vlan, Device, Interface]}
+
+
 class DevConfig:
   VLAN_GROUP                = "titanet"
   DEV_ROLE_EDGE             = "edge-sw"
@@ -98,22 +559,212 @@ class DevConfig:
   TAG_UPLINK                = "uplink"
   TAG_POE                   = "poe"
 
+  ## Keys read from the NetBox objects; "id" and "last_updated" are required by the snapshot delta sync.
+  ## VLANs, devices and interfaces are turned into records as each page arrives.
+  FIELDS = {
+    "sites": {
+      "id": None, "last_updated": None, "slug": None, "region": {"slug": None},
+    },
+    "vlans":      Vlan,
+    "devices":    Device,
+    "interfaces": Interface,
+  }
+
+  ## CAUTION: hardcoded hostnames
+  CORE_VLAN_DOMAIN = ["core-honkan", "core-gsic", "core-si", "core-s7"]
+
+
+  ## Management VLANs are looked up by tag: {region: {device role: tag}}
+  MGMT_VLAN_TAGS = {
+    REGION_OOKAYAMA: {
+      DEV_ROLE_EDGE: TAG_MGMT_EDGE_OOKAYAMA,
+      DEV_ROLE_CORE: TAG_MGMT_CORE_OOKAYAMA,
+    },
+    REGION_TAMACHI: {
+      DEV_ROLE_EDGE: TAG_MGMT_EDGE_OOKAYAMA,
+      DEV_ROLE_CORE: TAG_MGMT_CORE_OOKAYAMA,
+    },
+    REGION_SUZUKAKE: {
+      DEV_ROLE_EDGE: TAG_MGMT_EDGE_SUZUKAKE,
+      DEV_ROLE_CORE: TAG_MGMT_CORE_SUZUKAKE,
+    },
+  }
 
-  def __init__(self, netbox_cli):
-    self.all_sites = netbox_cli.get_all_sites()
-    self.all_vlans = self.__filter_vlan_group(netbox_cli.get_all_vlans())
-    self.all_devices = self.__filter_active_devices(netbox_cli.get_all_devices())
-    self.all_interfaces = self.__group_by_device(netbox_cli.get_all_interfaces())
+
+  ## MCLAG domains in order of precedence: (master tag, slave tag)
+  MCLAG_DOMAINS = [
+    (TAG_MCLAG_MASTER, TAG_MCLAG_SLAVE),
+    (TAG_MCLAG_MASTER_OOKAYAMA, TAG_MCLAG_SLAVE_OOKAYAMA),
+    (TAG_MCLAG_MASTER_SUZUKAKE, TAG_MCLAG_SLAVE_SUZUKAKE),
+  ]
+
+
+  def __init__(self, netbox_cli, limit=None):
+    self.__device_names = {}  # cache
+    self.__limit = parse_limit(limit)
+    self.__load(netbox_cli)
+
+
+  def __load(self, netbox_cli, sync=False):
+    use_cache = not sync
+    fields = DevConfig.FIELDS
+
+    ## Sites and VLANs are fetched alongside devices; interfaces follow the devices since they are filtered by them
+    with ThreadPoolExecutor(max_workers=4) as executor:
+      sites = executor.submit(netbox_cli.get_all_sites, use_cache=use_cache, sync=sync, projection=fields["sites"])
+      vlan_filter = {"group": DevConfig.VLAN_GROUP}
+      vlans = executor.submit(netbox_cli.get_all_vlans, use_cache=use_cache, sync=sync, params=vlan_filter,
+                              projection=fields["vlans"])
+      ## Stacked members are told by their names, e.g., "foo (2)", whether or not NetBox assigns them to a chassis
+      inactive_vc_members = [
+        executor.submit(netbox_cli.get_brief_devices, {"name__ic": " (", **inactive_filter}, sync=sync)
+        for inactive_filter in [{"status__n": "active"}, {"tag__n": DevConfig.TAG_ANSIBLE}]
+      ]
+
+      ## Let NetBox filter out the unmanaged objects; the client-side filters below are kept as they are
+      device_filter = {"tag": DevConfig.TAG_ANSIBLE, "status": "active", "exclude": "config_context"}
+      raw_devices = netbox_cli.get_all_devices(use_cache=use_cache, sync=sync, params=device_filter,
+                                               projection=fields["devices"])
+
+      ## Filtered-out members still disqualify their virtual chassis
+      self.__inactive_vc_members = {
+        d["name"] for members in inactive_vc_members for d in members.result() if self.__regex_device_name(d["name"])[0]
+      }
+      self.__raw_devices = raw_devices
+      self.__device_hosts = {d.id: self.__regex_device_name(d.name)[2] for d in raw_devices}
+      self.all_devices = self.__filter_active_devices(raw_devices)
+      self.all_sites = sites.result()
+      self.__build_region_index()
+      self.selected_devices = self.__filter_limit(self.all_devices)
+
+      ## Interfaces of the selected devices, including all members of the virtual chassis, and of the core VLAN domain.
+      ## Selecting a core switch pulls in the other cores, whose LAGs may be its MCLAG masters.
+      hostnames = {d.name for d in self.selected_devices}
+      if any(d.role == DevConfig.DEV_ROLE_CORE for d in self.selected_devices):
+        hostnames |= {d.name for d in self.all_devices if d.role == DevConfig.DEV_ROLE_CORE}
+      if hostnames & set(DevConfig.CORE_VLAN_DOMAIN):
+        hostnames |= set(DevConfig.CORE_VLAN_DOMAIN)
+      device_ids = [did for did, hostname in self.__device_hosts.items() if hostname in hostnames]
+      unmanaged_hostnames = hostnames - set(self.__device_hosts.values())
+      if unmanaged_hostnames:
+        unmanaged_devices = netbox_cli.get_brief_devices({"name": sorted(unmanaged_hostnames)}, sync=sync)
+        device_ids.extend(d["id"] for d in unmanaged_devices)
+
+      ## Group interfaces by device as each page arrives, while the remaining pages are still downloading
+      self.all_interfaces, self.__interface_hosts = {}, {}
+      netbox_cli.get_all_interfaces(use_cache=use_cache, sync=sync, device_ids=device_ids,
+                                    projection=fields["interfaces"], on_page=self.__group_by_device)
+
+      self.all_vlans = self.__filter_vlan_group(vlans.result())
     self.__all_core_mclag_interfaces = None  # cache
+    self.__core_vlans = None  # cache
+    self.__build_indexes()
+
+
+  def __build_region_index(self):
+    self.__regions = {}
+    for site in self.all_sites:
+      region = site["region"]["slug"] if site["region"] is not None else None
+      self.__regions.setdefault(site["slug"], region)
+
+
+  def __build_indexes(self):
+    self.__vlans = {}
+    self.__tagged_vlans = {}
+    self.__protected_vlans = {}
+    for vlan in self.all_vlans:
+      self.__vlans.setdefault(vlan.vid, vlan)
+      if DevConfig.TAG_PROTECT in vlan.tags:
+        self.__protected_vlans.setdefault(vlan.vid, vlan)
+      for tag in vlan.tags:
+        self.__tagged_vlans.setdefault(tag, vlan)
+
+    self.__devices = {}
+    for device in self.all_devices:
+      self.__devices.setdefault(device.name, device)
+
+
+  ## Pull the changes since the last snapshot and return the hostnames whose inventory may have changed.
+  ## The objects are compared with the ones in memory, as other runs may have written the snapshots in between.
+  def refresh(self, netbox_cli):
+    old_devices = self.all_devices
+    old_objects = self.__objects_by_id()
+    old_device_hosts = self.__device_hosts
+    old_interface_hosts = self.__interface_hosts
+    old_vids = self.__get_vids_by_host()
+
+    self.__load(netbox_cli, sync=True)
+    objects = self.__objects_by_id()
+    all_hosts = {d.name for d in [*old_devices, *self.all_devices]}
+
+    def changed_ids(kind):
+      old, new = old_objects[kind], objects[kind]
+      return {i for i in old.keys() | new.keys() if old.get(i) != new.get(i)}
+
+    dirty = set()
+
+    for did in changed_ids("devices"):
+      dirty.update(h for h in [old_device_hosts.get(did), self.__device_hosts.get(did)] if h is not None)
+
+    for iid in changed_ids("interfaces"):
+      dirty.update(h for h in [old_interface_hosts.get(iid), self.__interface_hosts.get(iid)] if h is not None)
+
+    changed_sites = {
+      site["slug"] for sid in changed_ids("sites") for site in [old_objects["sites"].get(sid), objects["sites"].get(sid)]
+      if site is not None
+    }
+    dirty.update(d.name for d in [*old_devices, *self.all_devices] if d.site in changed_sites)
+
+    changed_vlans = [
+      v for vid in changed_ids("vlans") for v in [old_objects["vlans"].get(vid), objects["vlans"].get(vid)]
+      if v is not None
+    ]
+    if any(DevConfig.TAG_PROTECT in v.tags or any(t[:10] == "mgmt-vlan-" for t in v.tags) for v in changed_vlans):
+      return all_hosts  # Protected and management VLANs are shared by every host
+    changed_vids = {v.vid for v in changed_vlans}
+    for vids_by_host in [old_vids, self.__get_vids_by_host()]:
+      dirty.update(h for h, vids in vids_by_host.items() if vids & changed_vids)
+
+    ## Core switches share the VLAN domain and MCLAG settings
+    core_hostnames = {d.name for d in self.all_devices if d.role == DevConfig.DEV_ROLE_CORE}
+    if dirty & core_hostnames:
+      dirty |= core_hostnames
+
+    return dirty & all_hosts
+
+
+  def __objects_by_id(self):
+    return {
+      "sites":      {s["id"]: s for s in self.all_sites},
+      "vlans":      {v.id: v for v in self.all_vlans},
+      "devices":    {d.id: d for d in self.__raw_devices},
+      "interfaces": {i.id: i for interfaces in self.all_interfaces.values() for i in interfaces.values()},
+    }
+
+
+  def __get_vids_by_host(self):
+    vids_by_host = {}
+    for hostname, interfaces in self.all_interfaces.items():
+      vids = vids_by_host[hostname] = set()
+      for prop in interfaces.values():
+        for vid in [prop.untagged_vid, *prop.tagged_vids]:
+          if vid is not None:
+            vids.add(vid)
+    return vids_by_host
 
 
   def __regex_device_name(self, device_name):
+    try:
+      return self.__device_names[device_name]
+    except KeyError:
+      pass
     dev_name_reg = re.match("([\w|-]+) \((\d+)\)", device_name)
     is_stacked = dev_name_reg is not None
     is_vc_slave = is_stacked and int(dev_name_reg.group(2)) > 1
     basename = device_name
     if is_stacked:
       basename = dev_name_reg.group(1)
+    self.__device_names[device_name] = is_stacked, is_vc_slave, basename
     return is_stacked, is_vc_slave, basename
 
 
@@ -126,9 +777,9 @@ class DevConfig:
   def __filter_vlan_group(self, vlans):
     filtered = []
     for vlan in vlans:
-      if vlan["group"] is None:
+      if vlan.group is None:
         continue
-      if vlan["group"]["slug"] == DevConfig.VLAN_GROUP:
+      if vlan.group == DevConfig.VLAN_GROUP:
         filtered.append(vlan)
     return filtered
 
@@ -139,9 +790,9 @@ class DevConfig:
     are_all_active = {}
 
     for dev in devices:
-      is_active = dev["status"]["value"] == "active"
-      has_ansible_tag = DevConfig.TAG_ANSIBLE in dev["tags"]
-      is_stacked, is_vc_slave, basename = self.__regex_device_name(dev["name"])
+      is_active = dev.status == "active"
+      has_ansible_tag = DevConfig.TAG_ANSIBLE in dev.tags
+      is_stacked, is_vc_slave, basename = self.__regex_device_name(dev.name)
 
       if is_stacked:
         try:
@@ -151,6 +802,10 @@ class DevConfig:
         if not is_vc_slave:
           vc_masters[basename] = dev
 
+    for name in self.__inactive_vc_members:
+      _, _, basename = self.__regex_device_name(name)
+      are_all_active[basename] = False
+
     for basename in [n for n, c in are_all_active.items() if c]:
       filtered.append(vc_masters[basename])
 
@@ -163,129 +818,130 @@ class DevConfig:
     unstacked_devices = []
 
     for dev in devices:
-      is_stacked, _, _ = self.__regex_device_name(dev["name"])
+      is_stacked, _, _ = self.__regex_device_name(dev.name)
       if not is_stacked:
         unstacked_devices.append(dev)
 
     for dev in [*stacked_devices, *unstacked_devices]:
-      is_active = dev["status"]["value"] == "active"
-      has_ansible_tag = DevConfig.TAG_ANSIBLE in dev["tags"]
-      has_ipaddr = dev["primary_ip"] is not None
-      _, _, basename = self.__regex_device_name(dev["name"])
-
-      if is_active and has_ansible_tag and has_ipaddr and not is_stacked:
-        dev["name"] = basename
+      is_active = dev.status == "active"
+      has_ansible_tag = DevConfig.TAG_ANSIBLE in dev.tags
+      has_ipaddr = dev.primary_ip is not None
+      _, is_vc_slave, basename = self.__regex_device_name(dev.name)
+
+      ## The masters of the stacked devices are already checked along with all their members
+      if is_active and has_ansible_tag and has_ipaddr and not is_vc_slave:
+        dev.name = basename
         filtered.append(dev)
 
     return filtered
 
 
+  def __filter_limit(self, devices):
+    if self.__limit is None:
+      return devices
+    names = lambda d: ["all", d.name, d.role.upper(), self.get_region(d.site)]
+    return [d for d in devices if match_limit(self.__limit, names(d))]
+
+
   def __group_by_device(self, interfaces):
-    arranged = {}
+    arranged = self.all_interfaces
     for interface in interfaces:
-      _, _, basename = self.__regex_device_name(interface["device"]["name"])
+      _, _, basename = self.__regex_device_name(interface.device)
+      self.__interface_hosts[interface.id] = basename
       try:
-        arranged[basename][interface["name"]] = interface
+        arranged[basename][interface.name] = interface
       except KeyError:
-        arranged[basename] = {interface["name"]: interface}
+        arranged[basename] = {interface.name: interface}
     return arranged
 
 
   def __get_vlan_name(self, vid):
-    for vlan in self.all_vlans:
-      if vlan["vid"] == vid:
-        return vlan["name"]
-    return None
+    try:
+      return self.__vlans[vid].name
+    except KeyError:
+      return None
 
 
   def get_region(self, site):
-    for s in self.all_sites:
-      if s["slug"] == site:
-        return s["region"]["slug"]
-    return None
+    return self.__regions.get(site)
 
 
-  def get_vlans(self, hostname):
-    vlans, vids, irb_vids = [], set(), set()
-    for ifname, prop in self.all_interfaces[hostname].items():
+  def __get_used_vids(self, hostname):
+    vids, irb_vids = set(), set()
+    for ifname, prop in self.all_interfaces.get(hostname, {}).items():
       is_irb_port = ifname[:4] == "irb."
-      for vlan in [prop["untagged_vlan"], *prop["tagged_vlans"]]:
-        if vlan is not None:
-          vids.add(vlan["vid"])
-        if is_irb_port:
-          irb_vids.add(vlan["vid"])
+      for vid in [prop.untagged_vid, *prop.tagged_vids]:
+        if vid is not None:
+          vids.add(vid)
+          if is_irb_port:
+            irb_vids.add(vid)
+    return vids, irb_vids
 
+
+  ## Protected VLANs are always emitted; the in-use ones are joined through the vid index. One entry per vid.
+  def __resolve_vlans(self, vids, irb_vids):
+    resolved = {vid: vlan for vid, vlan in self.__protected_vlans.items()}
     for vid in vids:
-      for vlan in self.all_vlans:
-        is_in_use_vlan = vlan["vid"] == vid
-        is_protected_vlan = "protect" in vlan["tags"]
-        is_irb_vlan = vlan["vid"] in irb_vids
-        if is_in_use_vlan or is_protected_vlan:
-          vlans.append({
-            "name":        vlan["name"],
-            "vid":         vlan["vid"],
-            "irb":         is_irb_vlan,
-            "used":        is_in_use_vlan,
-            "protected":   is_protected_vlan,
-            "description": vlan["description"],
-          })
-    return vlans
+      try:
+        resolved[vid] = self.__vlans[vid]
+      except KeyError:
+        pass
+
+    return [{
+      "name":        vlan.name,
+      "vid":         vid,
+      "irb":         vid in irb_vids,
+      "used":        vid in vids,
+      "protected":   vid in self.__protected_vlans,
+      "description": vlan.description,
+    } for vid, vlan in sorted(resolved.items())]
+
+
+  def get_vlans(self, hostname):
+    return self.__resolve_vlans(*self.__get_used_vids(hostname))
 
 
   def get_mgmt_vlan(self, device_role, region):
-    mgmt_vlan_tags = {
-      DevConfig.REGION_OOKAYAMA: {
-        DevConfig.DEV_ROLE_EDGE: DevConfig.TAG_MGMT_EDGE_OOKAYAMA,
-        DevConfig.DEV_ROLE_CORE: DevConfig.TAG_MGMT_CORE_OOKAYAMA,
-      },
-      DevConfig.REGION_TAMACHI: {
-        DevConfig.DEV_ROLE_EDGE: DevConfig.TAG_MGMT_EDGE_OOKAYAMA,
-        DevConfig.DEV_ROLE_CORE: DevConfig.TAG_MGMT_CORE_OOKAYAMA,
-      },
-      DevConfig.REGION_SUZUKAKE: {
-        DevConfig.DEV_ROLE_EDGE: DevConfig.TAG_MGMT_EDGE_SUZUKAKE,
-        DevConfig.DEV_ROLE_CORE: DevConfig.TAG_MGMT_CORE_SUZUKAKE,
-      },
+    tag = DevConfig.MGMT_VLAN_TAGS[region][device_role]
+    vlan = self.__tagged_vlans.get(tag)
+    if vlan is None:
+      return None
+    return {
+      "name":        vlan.name,
+      "vid":         vlan.vid,
+      "description": vlan.description,
     }
 
-    for vlan in self.all_vlans:
-      if mgmt_vlan_tags[region][device_role] in vlan["tags"]:
-        return {
-          "name":        vlan["name"],
-          "vid":         vlan["vid"],
-          "description": vlan["description"],
-        }
-    return None
-
 
   def get_all_devices(self):
     return [{
-      "hostname": d["name"],
-      "role":     d["device_role"]["slug"],
-      "region":   self.get_region(d["site"]["slug"]),
-    } for d in self.all_devices]
+      "hostname": d.name,
+      "role":     d.role,
+      "region":   self.get_region(d.site),
+    } for d in self.selected_devices]
 
 
   def get_manufacturer(self, hostname):
-    for d in self.all_devices:
-      if d["name"] == hostname:
-        return d["device_type"]["manufacturer"]["slug"]
-    return None
+    try:
+      return self.__devices[hostname].manufacturer
+    except KeyError:
+      return None
 
 
   def get_ip_address(self, hostname):
     ip = lambda cidr: cidr.split("/")[0]
-    for d in self.all_devices:
-      if d["name"] == hostname:
-        return ip(d["primary_ip"]["address"])
+    try:
+      return ip(self.__devices[hostname].primary_ip)
+    except KeyError:
+      return None
 
 
   def get_lag_members(self, hostname):
     lag_members = {}
     for ifname, prop in self.all_interfaces[hostname].items():
       _, is_lag_port = self.__regex_interface_name(ifname)
-      is_lag_member_port = prop["lag"] is not None
-      is_upstream_port = DevConfig.TAG_UPLINK in prop["tags"]
+      is_lag_member_port = prop.lag is not None
+      is_upstream_port = DevConfig.TAG_UPLINK in prop.tags
 
       if is_upstream_port:
         continue
@@ -295,13 +951,42 @@ class DevConfig:
           lag_members[ifname] = []
       elif is_lag_member_port:
         try:
-          lag_members[prop["lag"]["name"]].append(ifname)
+          lag_members[prop.lag].append(ifname)
         except KeyError:
-          lag_members[prop["lag"]["name"]] = [ifname]
+          lag_members[prop.lag] = [ifname]
 
     return lag_members
 
 
+  ## Format conversion of the VLAN mode: from netbox to juniper/cisco style
+  def __convert_vlan_mode(self, prop):
+    vlan_mode, native_vid, vids, is_trunk_all = None, None, [], False
+    if prop.mode is None:
+      return vlan_mode, native_vid, vids, is_trunk_all
+
+    vlan_mode = prop.mode.lower()
+    has_untagged_vid = prop.untagged_vid is not None
+    has_tagged_vid = prop.tagged_vids is not None
+
+    if vlan_mode == "access":
+      if has_untagged_vid:
+        vids = [prop.untagged_vid]
+
+    elif vlan_mode == "tagged":
+      vlan_mode = "trunk"
+      if has_tagged_vid:
+        vids = list(prop.tagged_vids)
+      if has_untagged_vid:
+        native_vid = prop.untagged_vid
+        vids.append(native_vid)
+
+    elif vlan_mode == "tagged-all":
+      vlan_mode = "trunk"
+      is_trunk_all = True
+
+    return vlan_mode, native_vid, vids, is_trunk_all
+
+
   def get_interfaces(self, hostname):
     interfaces = {}
 
@@ -314,168 +999,107 @@ class DevConfig:
       "100gbase-x-cpak", "100gbase-x-qsfp28", "200gbase-x-cfp2", "200gbase-x-qsfp56", "400gbase-x-qsfpdd", "400gbase-x-osfp",
     ]
 
+    is_cisco = self.get_manufacturer(hostname) == "cisco"
+
     for ifname, prop in self.all_interfaces[hostname].items():
-      is_target_iftype = prop["type"]["value"] in [*iftypes_virtual, *iftypes_ethernet]
-      is_protected = DevConfig.TAG_PROTECT in prop["tags"]
+      is_target_iftype = prop.type in [*iftypes_virtual, *iftypes_ethernet]
+      is_protected = DevConfig.TAG_PROTECT in prop.tags
       _, is_lag_port = self.__regex_interface_name(ifname)
-      is_lag_member_port = prop["lag"] is not None
-      is_upstream_port = DevConfig.TAG_UPLINK in prop["tags"]
-      is_poe_port = DevConfig.TAG_POE in prop["tags"]
+      is_lag_member_port = prop.lag is not None
+      is_upstream_port = DevConfig.TAG_UPLINK in prop.tags
+      is_poe_port = DevConfig.TAG_POE in prop.tags
 
       if not is_target_iftype or is_protected:
         continue
 
-      description = prop["description"]
-      is_vlan_port = prop["mode"] is not None
+      description = prop.description
       vlan_mode, native_vid, vids, is_trunk_all = None, None, [], False
 
       if is_upstream_port:
         vlan_mode = "trunk"
         is_trunk_all = True
-
-      if not is_upstream_port and is_vlan_port:
-        vlan_mode = prop["mode"]["value"].lower()
-        has_untagged_vid = prop["untagged_vlan"] is not None
-        has_tagged_vid = prop["tagged_vlans"] is not None
-
-        if vlan_mode == "access":
-          if has_untagged_vid:
-            vid = prop["untagged_vlan"]["vid"]
-            vids = [vid]
-            vlan_name = self.__get_vlan_name(vid)
-            if description == "" and vlan_name is not None:
-              description = vlan_name
-
-        elif vlan_mode == "tagged":
-          vlan_mode = "trunk"  # Format conversion: from netbox to juniper/cisco style
-          if has_tagged_vid:
-            vids = [v["vid"] for v in prop["tagged_vlans"]]
-          if has_untagged_vid:
-            native_vid = prop["untagged_vlan"]["vid"]
-            vids.append(native_vid)
-
-        elif vlan_mode == "tagged-all":
-          vlan_mode = "trunk"
-          is_trunk_all = True
-
-      ## Cisco
-      removed_vids = [vid for vid in range(1,4095) if vid not in vids]
-      removed_vids_packed = [removed_vids[i:i+20] for i in range(0, len(removed_vids), 20)]
+      else:
+        vlan_mode, native_vid, vids, is_trunk_all = self.__convert_vlan_mode(prop)
+        if vlan_mode == "access" and vids:
+          vlan_name = self.__get_vlan_name(vids[0])
+          if description == "" and vlan_name is not None:
+            description = vlan_name
 
       interfaces[ifname] = {
         "physical":     not is_lag_port,
-        "enabled":      prop["enabled"] or is_upstream_port,
+        "enabled":      prop.enabled or is_upstream_port,
         "description":  description,
         "lag_member":   is_lag_member_port,
         "poe":          is_poe_port,
         "auto_speed":   True,
         "vlan_mode":    vlan_mode,
         "vids":         vids,
-        "removed_vids": removed_vids_packed,
         "native_vid":   native_vid,
         "trunk_all":    is_trunk_all,
         "skip_delete":  is_upstream_port,
       }
 
+      ## Cisco: "switchport trunk allowed vlan remove" takes up to 20 ranges per line
+      if is_cisco:
+        removed_vids = removed_vid_ranges(vids)
+        interfaces[ifname]["removed_vids"] = [removed_vids[i:i+20] for i in range(0, len(removed_vids), 20)]
+
     return interfaces
 
 
-  ## ToDo: need refactoring but soon to be obsoleted
+  ## Core LAGs tagged as MCLAG slaves inherit the settings of the master LAG of the same name in the same domain
   def get_core_mclag_interfaces(self, hostname):
-    if self.__all_core_mclag_interfaces is not None:
-      try:
-        return self.__all_core_mclag_interfaces[hostname]
-      except KeyError:
-        return {}
-    self.__all_core_mclag_interfaces = {}
-
-    def has_tag(prop, *tags):
-      for tag in tags:
-        if tag in prop["tags"]:
-          return True
-      return False
+    if self.__all_core_mclag_interfaces is None:
+      self.__all_core_mclag_interfaces = self.__pair_core_mclag_interfaces()
+    return self.__all_core_mclag_interfaces.get(hostname, {})
 
-    is_core = lambda d: d["device_role"]["slug"] == DevConfig.DEV_ROLE_CORE
-    core_hostnames = [d["name"] for d in self.all_devices if is_core(d)]
-    migrate_keys = ["enabled", "mode", "tagged_vlans", "untagged_vlan", "description", "tags"]
-    masters, masters_o, masters_s = {}, {}, {}
-
-    for hname in core_hostnames:
-      for ifname, prop in self.all_interfaces[hname].items():
-        is_lag_parent = prop["type"]["value"] == "lag"
-        if not is_lag_parent:
-          continue
 
-        master_prop = {key: prop[key] for key in migrate_keys}
-        if has_tag(prop, DevConfig.TAG_MCLAG_MASTER):
-          masters[ifname] = master_prop
-        elif has_tag(prop, DevConfig.TAG_MCLAG_MASTER_OOKAYAMA):
-          masters_o[ifname] = master_prop
-        elif has_tag(prop, DevConfig.TAG_MCLAG_MASTER_SUZUKAKE):
-          masters_s[ifname] = master_prop
+  def __pair_core_mclag_interfaces(self):
+    is_core = lambda d: d.role == DevConfig.DEV_ROLE_CORE
+    core_hostnames = [d.name for d in self.all_devices if is_core(d)]
+    masters, members = {}, []
 
+    ## Single pass over the LAG parents: index masters by (domain, LAG name), and remember every domain member
     for hname in core_hostnames:
-      for ifname, prop in self.all_interfaces[hname].items():
-        is_lag_parent = prop["type"]["value"] == "lag"
-        if not is_lag_parent:
+      for ifname, prop in self.all_interfaces.get(hname, {}).items():
+        if prop.type != "lag":
           continue
 
-        try:
-          master_prop = None
-          if has_tag(prop, DevConfig.TAG_MCLAG_SLAVE, DevConfig.TAG_MCLAG_MASTER):
-            master_prop = masters[ifname]
-          elif has_tag(prop, DevConfig.TAG_MCLAG_SLAVE_OOKAYAMA, DevConfig.TAG_MCLAG_MASTER_OOKAYAMA):
-            master_prop = masters_o[ifname]
-          elif has_tag(prop, DevConfig.TAG_MCLAG_SLAVE_SUZUKAKE, DevConfig.TAG_MCLAG_MASTER_SUZUKAKE):
-            master_prop = masters_s[ifname]
-          else:
-            continue
-        except KeyError:
-          continue
-
-        is_protected = DevConfig.TAG_PROTECT in master_prop["tags"]
-        if is_protected:
-          continue
-
-        is_vlan_port = master_prop["mode"] is not None
-        vlan_mode, native_vid, vids, is_trunk_all = None, None, [], False
-        if is_vlan_port:
-          vlan_mode = master_prop["mode"]["value"].lower()
-          has_untagged_vid = master_prop["untagged_vlan"] is not None
-          has_tagged_vid = master_prop["tagged_vlans"] is not None
-
-          if vlan_mode == "access":
-            if has_untagged_vid:
-              vid = master_prop["untagged_vlan"]["vid"]
-              vids = [vid]
-
-          elif vlan_mode == "tagged":
-            vlan_mode = "trunk"  # Format conversion: from netbox to juniper/cisco style
-            if has_tagged_vid:
-              vids = [v["vid"] for v in master_prop["tagged_vlans"]]
-            if has_untagged_vid:
-              native_vid = master_prop["untagged_vlan"]["vid"]
-              vids.append(native_vid)
-
-          elif vlan_mode == "tagged-all":
-            vlan_mode = "trunk"
-            is_trunk_all = True
-
-        prop = {
-          "enabled":     master_prop["enabled"],
-          "description": master_prop["description"],
-          "vlan_mode":   vlan_mode,
-          "vids":        vids,
-          "native_vid":  native_vid,
-          "trunk_all":   is_trunk_all,
-        }
-
-        try:
-          self.__all_core_mclag_interfaces[hname][ifname] = prop
-        except KeyError:
-          self.__all_core_mclag_interfaces[hname] = {ifname: prop}
+        master_domain, member_domain = None, None
+        for domain, (master_tag, slave_tag) in enumerate(DevConfig.MCLAG_DOMAINS):
+          if master_domain is None and master_tag in prop.tags:
+            master_domain = domain
+          if member_domain is None and (master_tag in prop.tags or slave_tag in prop.tags):
+            member_domain = domain
+
+        if master_domain is not None:
+          masters[master_domain, ifname] = prop
+        if member_domain is not None:
+          members.append((hname, ifname, member_domain))
+
+    ## Resolve each master once and share the result with all of its members
+    resolved = {}
+    for key, master_prop in masters.items():
+      if DevConfig.TAG_PROTECT in master_prop.tags:
+        continue
+      vlan_mode, native_vid, vids, is_trunk_all = self.__convert_vlan_mode(master_prop)
+      resolved[key] = {
+        "enabled":     master_prop.enabled,
+        "description": master_prop.description,
+        "vlan_mode":   vlan_mode,
+        "vids":        vids,
+        "native_vid":  native_vid,
+        "trunk_all":   is_trunk_all,
+      }
 
-    return self.__all_core_mclag_interfaces[hostname]
+    mclag_interfaces = {}
+    for hname, ifname, domain in members:
+      try:
+        prop = resolved[domain, ifname]
+      except KeyError:
+        continue
+      mclag_interfaces.setdefault(hname, {})[ifname] = {**prop, "vids": list(prop["vids"])}
+    return mclag_interfaces
 
 
   def get_device_interfaces(self, role, hostname):
@@ -486,19 +1110,36 @@ class DevConfig:
     return interfaces
 
 
-  ## CAUTION: hardcoded hostnames
+  ## Core switches share one VLAN domain: each of them carries the VLANs used by any of them
   def get_device_vlans(self, hostname):
-    vlans = self.get_vlans(hostname)
-    uniq_vlans = []
-    if hostname in ["core-gsic", "core-honkan", "core-si", "core-s7"]:
-      vlans.extend(self.get_vlans("core-honkan"))
-      vlans.extend(self.get_vlans("core-gsic"))
-      vlans.extend(self.get_vlans("core-si"))
-      vlans.extend(self.get_vlans("core-s7"))
-    for vlan in vlans:
-      if vlan not in uniq_vlans:
-        uniq_vlans.append(vlan)
-    return uniq_vlans
+    if hostname not in DevConfig.CORE_VLAN_DOMAIN:
+      return self.get_vlans(hostname)
+
+    if self.__core_vlans is None:
+      vids, irb_vids = set(), set()
+      for core_hostname in DevConfig.CORE_VLAN_DOMAIN:
+        core_vids, core_irb_vids = self.__get_used_vids(core_hostname)
+        vids |= core_vids
+        irb_vids |= core_irb_vids
+      self.__core_vlans = self.__resolve_vlans(vids, irb_vids)
+    return [dict(vlan) for vlan in self.__core_vlans]
+
+
+  ## All VLANs of the group, keyed by the VID as a string as JSON does
+  def get_vlan_catalog(self):
+    return {str(vid): {
+      "name":        vlan.name,
+      "vid":         vid,
+      "protected":   vid in self.__protected_vlans,
+      "description": vlan.description,
+    } for vid, vlan in sorted(self.__vlans.items())}
+
+
+  def get_mgmt_vlans(self):
+    return {
+      region: {role: self.get_mgmt_vlan(role, region) for role in tags.keys()}
+      for region, tags in DevConfig.MGMT_VLAN_TAGS.items()
+    }
 
 
 def __load_encrypted_secrets():
@@ -513,52 +1154,295 @@ def __load_encrypted_secrets():
       sys.exit(1)
 
 
+def netbox_credentials():
+  if NETBOX_URL is not None:
+    return NETBOX_URL, NETBOX_API_TOKEN
+  secrets = __load_encrypted_secrets()
+  return secrets["netbox_url"], secrets["netbox_api_token"]
+
+
+## Ask the inventory daemon (inventoryd.py) if it is running; None tells the caller to build the inventory by itself
+def query_daemon(request, socket_path=NETBOX_SOCKET, raw=False):
+  if not os.path.exists(socket_path):
+    return None
+  try:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+      sock.settimeout(NETBOX_TIMEOUT)
+      sock.connect(socket_path)
+      sock.sendall(json.dumps(request).encode() + b"\n")
+      sock.shutdown(socket.SHUT_WR)
+      response = b"".join(iter(lambda: sock.recv(65536), b""))
+    return response if raw else json.loads(response)
+  except (OSError, ValueError) as e:
+    print("Inventory daemon is not available, falling back to NetBox:", e, file=sys.stderr)
+    return None
+
+
+def dump_json(obj):
+  if orjson is not None:
+    return orjson.dumps(obj)
+  return json.dumps(obj).encode()
+
+
 def timestamp():
   n = datetime.now()
   return n.strftime("%Y-%m-%d@%H-%M-%S")
 
 
-def dynamic_inventory():
-  ts = timestamp()
-  secrets = __load_encrypted_secrets()
-  nb = NetBoxClient(secrets["netbox_url"], secrets["netbox_api_token"])
-  cf = DevConfig(nb)
+## Hash of the templates of the manufacturer: fixing a template changes the intent of all its hosts
+TEMPLATE_DIGESTS = {}
 
-  devices = cf.get_all_devices()
-  inventory = {
-    "_meta": {
-      "hostvars": {}
+
+def template_digest(manufacturer):
+  if manufacturer not in TEMPLATE_DIGESTS:
+    h = hashlib.sha256()
+    tpl_dir = os.path.join(ROLES_DIR, str(manufacturer), "templates")
+    for tpl_name in sorted(os.listdir(tpl_dir)) if os.path.isdir(tpl_dir) else []:
+      with open(os.path.join(tpl_dir, tpl_name), "rb") as fd:
+        h.update(tpl_name.encode() + b"\0" + fd.read() + b"\0")
+    TEMPLATE_DIGESTS[manufacturer] = h.hexdigest()
+  return TEMPLATE_DIGESTS[manufacturer]
+
+
+## Stable digest of what gets deployed to the host, regardless of the layout and the datetime
+def intent_hash(manufacturer, interfaces, vlans, lag_members, mgmt_vlan):
+  intent = {
+    "templates":   template_digest(manufacturer),
+    "interfaces":  interfaces,
+    "vlans":       vlans,
+    "lag_members": lag_members,
+    "mgmt_vlan":   mgmt_vlan,
+  }
+  canonical = json.dumps(intent, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+  return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+## Recorded by the playbooks after each successful deployment; see roles/*/tasks/migrate.yml
+def deployed_intent_hash(hostname, intent_dir=NETBOX_INTENT_DIR):
+  try:
+    with open(os.path.join(intent_dir, f"{hostname}.sha256")) as fd:
+      return fd.read().strip()
+  except OSError:
+    return None
+
+
+## Hosts whose intent differs from the last deployment, including those never deployed
+def changed_hosts(all_hostvars, intent_dir=NETBOX_INTENT_DIR):
+  return [hostname for hostname, hostvars in all_hostvars.items()
+          if hostvars["intent_hash"] != deployed_intent_hash(hostname, intent_dir)]
+
+
+## With the VLAN catalog, hosts refer to the VLANs by VID; see inventory_vars()
+def build_hostvars(cf, device, ts, catalog=NETBOX_VLAN_CATALOG):
+  hostname = device["hostname"]
+  region = device["region"]
+  role = device["role"]
+  manufacturer = cf.get_manufacturer(hostname)
+  vlans = cf.get_device_vlans(hostname)
+  mgmt_vlan = cf.get_mgmt_vlan(role, region)
+  interfaces = cf.get_device_interfaces(role, hostname)
+  lag_members = cf.get_lag_members(hostname)
+  digest = intent_hash(manufacturer, interfaces, vlans, lag_members, mgmt_vlan)
+
+  if catalog:
+    return {
+      "hostname":     hostname,
+      "region":       region,
+      "role":         role,
+      "manufacturer": manufacturer,
+      "vlan_vids":    [v["vid"] for v in vlans if v["used"]],
+      "irb_vids":     [v["vid"] for v in vlans if v["irb"]],
+      "interfaces":   interfaces,
+      "lag_members":  lag_members,
+      "ansible_host": cf.get_ip_address(hostname),
+      "intent_hash":  digest,
+      "datetime":     ts,
     }
+
+  return {
+    "hostname":     hostname,
+    "region":       region,
+    "manufacturer": manufacturer,
+    "vlans":        vlans,
+    "mgmt_vlan":    mgmt_vlan,
+    "interfaces":   interfaces,
+    "lag_members":  lag_members,
+    "ansible_host": cf.get_ip_address(hostname),
+    "intent_hash":  digest,
+    "datetime":     ts,
   }
 
+
+## Forked workers inherit the loaded DevConfig as it is; only the devices and the hostvars cross the process boundary
+FORKED_BUILD = {}
+
+
+def build_forked_hostvars(device):
+  return build_hostvars(FORKED_BUILD["config"], device, FORKED_BUILD["timestamp"], FORKED_BUILD["catalog"])
+
+
+def iter_hostvars(cf, devices, ts, workers=NETBOX_BUILD_WORKERS, catalog=NETBOX_VLAN_CATALOG):
+  workers = workers or os.cpu_count() or 1
+  workers = min(workers, len(devices))
+  if workers < 2 or "fork" not in multiprocessing.get_all_start_methods():
+    for device in devices:
+      yield build_hostvars(cf, device, ts, catalog)
+    return
+
+  FORKED_BUILD.update(config=cf, timestamp=ts, catalog=catalog)
+  try:
+    with multiprocessing.get_context("fork").Pool(workers) as pool:
+      chunksize = max(1, len(devices) // (workers * 4))
+      yield from pool.imap(build_forked_hostvars, devices, chunksize=chunksize)  # Results keep the order of the devices
+  finally:
+    FORKED_BUILD.clear()
+
+
+def load_config(refresh=False, limit=NETBOX_LIMIT):
+  netbox_url, netbox_api_token = netbox_credentials()
+  nb = NetBoxClient(netbox_url, netbox_api_token, refresh=refresh or NETBOX_REFRESH)
+  cf = DevConfig(nb, limit=limit)
+  if NETBOX_STATS:
+    print("NetBox:", nb.session.report(), file=sys.stderr)
+  return cf
+
+
+## Group vars of "all" in the VLAN catalog layout: the templates resolve the VIDs of the hosts through them
+def inventory_vars(cf):
+  return {
+    "vlan_catalog": cf.get_vlan_catalog(),
+    "mgmt_vlans":   cf.get_mgmt_vlans(),
+  }
+
+
+def inventory_groups(devices):
+  groups = {}
   for device in devices:
     hostname = device["hostname"]
-    role = device["role"]
-    group = role.upper()
+    group = device["role"].upper()
     try:
-      inventory[group]["hosts"].append(hostname)
+      groups[group]["hosts"].append(hostname)
     except KeyError:
-      inventory[group] = {"hosts": [hostname]}
+      groups[group] = {"hosts": [hostname]}
+  return groups
 
-    inventory["_meta"]["hostvars"][hostname] = {
-      "hostname":     hostname,
-      "region":       device["region"],
-      "manufacturer": cf.get_manufacturer(hostname),
-      "vlans":        cf.get_device_vlans(hostname),
-      "mgmt_vlan":    cf.get_mgmt_vlan(role, device["region"]),
-      "interfaces":   cf.get_device_interfaces(role, hostname),
-      "lag_members":  cf.get_lag_members(hostname),
-      "ansible_host": cf.get_ip_address(hostname),
-      "datetime":     ts,
+
+## Applies the limit hint to an inventory built earlier, e.g., written to a file by "netbox.py -o"
+def limit_inventory(inventory, limit):
+  limit = parse_limit(limit)
+  if limit is None:
+    return inventory
+
+  hostvars = inventory["_meta"]["hostvars"]
+  limited = {
+    "_meta": {
+      "hostvars": {}
     }
+  }
+
+  for group, members in inventory.items():
+    if group == "_meta":
+      continue
+    if "vars" in members:
+      limited[group] = {"vars": members["vars"]}
+    if group == CHANGED_GROUP:  # Follows the groups by role; its hosts are kept as they were matched there
+      limited[group] = {"hosts": [h for h in members["hosts"] if h in limited["_meta"]["hostvars"]]}
+      continue
+    for hostname in members.get("hosts", []):
+      if not match_limit(limit, ["all", hostname, group, hostvars[hostname]["region"]]):
+        continue
+      try:
+        limited[group]["hosts"].append(hostname)
+      except KeyError:
+        limited[group] = {"hosts": [hostname]}
+      limited["_meta"]["hostvars"][hostname] = hostvars[hostname]
+
+  return limited
+
+
+def dynamic_inventory(refresh=False, workers=NETBOX_BUILD_WORKERS, limit=NETBOX_LIMIT, daemon=True,
+                      catalog=NETBOX_VLAN_CATALOG):
+  if daemon and not refresh and not NETBOX_REFRESH:
+    inventory = query_daemon({"limit": limit})
+    if inventory is not None:
+      return inventory
+
+  ts = timestamp()
+  cf = load_config(refresh=refresh, limit=limit)
+  devices = cf.get_all_devices()
+  inventory = {
+    "_meta": {
+      "hostvars": {}
+    },
+    **inventory_groups(devices),
+  }
+
+  for device, hostvars in zip(devices, iter_hostvars(cf, devices, ts, workers=workers, catalog=catalog)):
+    inventory["_meta"]["hostvars"][device["hostname"]] = hostvars
 
+  inventory[CHANGED_GROUP] = {"hosts": changed_hosts(inventory["_meta"]["hostvars"])}
+  if catalog:
+    inventory["all"] = {"vars": inventory_vars(cf)}
   return inventory
 
 
-if __name__ == "__main__":
-  inventory = dynamic_inventory()
-  print(json.dumps(inventory))
+## Same document as dynamic_inventory(), written to the binary stream host by host as soon as each is built.
+## Only one host is held in memory at a time, and Ansible starts reading before the last host is done.
+def stream_inventory(fd, refresh=False, workers=NETBOX_BUILD_WORKERS, limit=NETBOX_LIMIT, catalog=NETBOX_VLAN_CATALOG):
+  if not refresh and not NETBOX_REFRESH:
+    raw = query_daemon({"limit": limit}, raw=True)
+    if raw is not None:
+      fd.write(raw + b"\n")
+      return
+
+  ts = timestamp()
+  cf = load_config(refresh=refresh, limit=limit)
+  devices = cf.get_all_devices()
+
+  fd.write(b'{"_meta": {"hostvars": {')
+  all_hostvars = iter_hostvars(cf, devices, ts, workers=workers, catalog=catalog)
+  intent_hashes = {}
+  for n, (device, hostvars) in enumerate(zip(devices, all_hostvars)):
+    fd.write((b", " if n > 0 else b"") + dump_json(device["hostname"]) + b": " + dump_json(hostvars))
+    fd.flush()
+    intent_hashes[device["hostname"]] = {"intent_hash": hostvars["intent_hash"]}
+  fd.write(b"}}")
+  for group, members in inventory_groups(devices).items():
+    fd.write(b", " + dump_json(group) + b": " + dump_json(members))
+  fd.write(b", " + dump_json(CHANGED_GROUP) + b": " + dump_json({"hosts": changed_hosts(intent_hashes)}))
+  if catalog:
+    fd.write(b', "all": ' + dump_json({"vars": inventory_vars(cf)}))
+  fd.write(b"}\n")
+  fd.flush()
+
+
+def main():
+  parser = argparse.ArgumentParser(description="dynamic inventory of the switches managed in NetBox")
+  parser.add_argument("--list", action="store_true", help="list all hosts with their hostvars (default)")
+  parser.add_argument("--host", dest="HOSTNAME", help="show the hostvars of the host only")
+  parser.add_argument("--limit", dest="PATTERN", default=NETBOX_LIMIT, help="build the matching hosts only (e.g., 'minami3,EDGE-SW:!ookayama')")
+  parser.add_argument("-o", "--output", dest="FILE_PATH", help="write the inventory to the file instead of stdout (e.g., for renderer.py -i)")
+  args = parser.parse_args()
+
+  if args.HOSTNAME is not None:
+    hostvars = query_daemon({"host": args.HOSTNAME})
+    if hostvars is None:
+      inventory = dynamic_inventory(limit=args.HOSTNAME, daemon=False)
+      hostvars = inventory["_meta"]["hostvars"].get(args.HOSTNAME, {})
+    print(json.dumps(hostvars))
+    return
+
+  if args.FILE_PATH is not None:
+    with open(args.FILE_PATH, "wb") as fd:
+      stream_inventory(fd, limit=args.PATTERN)
+    return
+
+  stream_inventory(sys.stdout.buffer, limit=args.PATTERN)
 
   ## for deadman
-  #for hostname, props in inventory["_meta"]["hostvars"].items():
+  #for hostname, props in dynamic_inventory()["_meta"]["hostvars"].items():
   #  print(hostname, props["ansible_host"])
+
+
+if __name__ == "__main__":
+  main()
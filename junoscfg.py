@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import os
+import re
+import shlex
+import sys
+
+CURDIR = os.path.dirname(os.path.abspath(__file__))
+BACKUP_DIRS = os.path.join(CURDIR, "backup/juniper_config.*")  # Named by the datetime, so they sort by time
+
+## Statements taking exactly one value: setting another value replaces the current one instead of adding to it
+SINGLE_VALUED = {
+  "description", "vlan-id", "l3-interface", "interface-mode", "native-vlan-id", "speed", "mtu", "802.3ad",
+}
+
+## Flags excluding each other under the same parent
+EXCLUSIVE = [
+  {"enable", "disable"},
+  {"active", "passive"},
+  {"auto-negotiation", "no-auto-negotiation"},
+]
+
+MARK = None  # Key of the tree nodes telling the statement is configured by itself, e.g., "disable;"
+
+LEAF_LISTS = {"members"}  # Statements taking a list of values, which may be given at once in brackets
+RANGE_PREFIX = "TN4-"  # Interface ranges generated by compact_commands(); others are left to the operators
+PHYSICAL_INTERFACE = re.compile(r"^[a-z]{2,3}-\d+/\d+/\d+$")  # Members of an interface range, e.g., ge-0/0/1
+
+TOKEN = re.compile(r'"(?:\\.|[^"\\])*"|/\*.*?\*/|#[^\n]*|[{};\[\]]|[^\s{};\[\]"]+', re.S)
+QUOTE_NEEDED = re.compile(r'[\s{};\[\]"#]')
+MARKERS = ["protect:", "replace:"]
+INACTIVE = "inactive:"
+
+
+def unquote(token):
+  if token.startswith('"'):
+    return re.sub(r'\\(.)', r'\1', token[1:-1])
+  return token
+
+
+def quote(token):
+  if token == "" or QUOTE_NEEDED.search(token):
+    return '"' + token.replace("\\", "\\\\").replace('"', '\\"') + '"'
+  return token
+
+
+def expand(words):
+  if "[" not in words:
+    return [words]
+  start, end = words.index("["), words.index("]")
+  return [words[:start] + [item] + words[end+1:] for item in words[start+1:end]]
+
+
+## Parses the configuration in either the curly-brace text format ("show configuration") or the set format
+## ("show configuration | display set") into the paths of the statements, e.g., ("vlans", "vlan110", "vlan-id", "110").
+## The paths of the deactivated statements ("inactive:", or "deactivate" in the set format) are added to inactive.
+def parse_config(text, inactive=None):
+  inactive = set() if inactive is None else inactive
+  lines = [l.strip() for l in text.splitlines()]
+  if any(l.startswith("set ") for l in lines):
+    inactive.update(tuple(p) for l in lines if l.startswith("deactivate ") for p in expand(parse_command(l)[1]))
+    return [tuple(p) for l in lines if l.startswith("set ") for p in expand(parse_command(l)[1])]
+
+  paths, stack, words, is_inactive = [], [], [], False
+  for token in TOKEN.findall(text):
+    if token.startswith(("/*", "#")) or token in MARKERS:
+      continue
+    if token == INACTIVE:
+      is_inactive = True
+    elif token == "{":
+      if is_inactive:
+        inactive.add(tuple(w for ws in stack for w in ws) + tuple(words))
+      stack.append(words)
+      words, is_inactive = [], False
+    elif token == "}":
+      words, is_inactive = [], False
+      if stack:
+        stack.pop()
+    elif token == ";":
+      parents = [w for ws in stack for w in ws]
+      paths.extend(tuple(parents + p) for p in expand(words))
+      if is_inactive:
+        inactive.update(tuple(parents + p) for p in expand(words))
+      words, is_inactive = [], False
+    else:
+      words.append(unquote(token))
+  return paths
+
+
+def parse_command(line):
+  words = shlex.split(line, comments=False, posix=True)
+  return words[0], words[1:]
+
+
+## Statements configured, as nested dicts of the tokens, along with the paths of the deactivated ones. Deleting a
+## statement deletes its "inactive" flag as well, so setting it again makes it active.
+class ConfigTree:
+  def __init__(self, paths=(), inactive=()):
+    self.root = {}
+    self.inactive = set(inactive)
+    for path in paths:
+      self.set(path)
+
+
+  def __contains__(self, path):
+    return self.__node(path) is not None
+
+
+  def __node(self, path):
+    node = self.root
+    for token in path:
+      node = node.get(token)
+      if node is None:
+        return None
+    return node
+
+
+  def set(self, path):
+    parent = self.__node(path[:-1])
+    if parent is not None and len(path) >= 2 and path[-2] in SINGLE_VALUED:
+      parent.clear()  # The node of the statement, e.g., "description", holding the value
+    if parent is not None:
+      for flags in EXCLUSIVE:
+        if path[-1] in flags:
+          for flag in flags - {path[-1]}:
+            parent.pop(flag, None)
+
+    node = self.root
+    for token in path:
+      node = node.setdefault(token, {})
+    node[MARK] = True
+
+
+  def delete(self, path):
+    nodes = [self.root]
+    for token in path:
+      node = nodes[-1].get(token)
+      if node is None:
+        return  # Deleting what is not configured is no error on Junos either
+      nodes.append(node)
+    nodes[-2].pop(path[-1])
+    for token, parent, node in reversed(list(zip(path[:-1], nodes[:-2], nodes[1:-1]))):
+      if node:
+        break
+      parent.pop(token)  # Containers left empty are gone as well
+    self.inactive = {p for p in self.inactive if p[:len(path)] != path}
+
+
+  def apply(self, commands):
+    for line in commands:
+      if not line.strip() or line.lstrip().startswith("#"):
+        continue
+      command, words = parse_command(line)
+      for path in expand(words):
+        if command == "set":
+          self.set(tuple(path))
+        elif command == "delete":
+          self.delete(tuple(path))
+        else:
+          raise ValueError(f"Unsupported command: {line}")
+
+
+  ## Moves the settings of the generated interface ranges to their members, i.e., what the switch actually runs.
+  ## Statements of a member itself take precedence over those of the range, as on Junos.
+  def expand_ranges(self, prefix=RANGE_PREFIX):
+    ranges = self.root.get("interfaces", {}).get("interface-range", {})
+    for name in [n for n in ranges if n is not MARK and n.startswith(prefix)]:
+      members = [m for m in ranges[name].get("member", {}) if m is not MARK]
+      settings = [p for p in self.paths(ranges[name]) if p and p[0] != "member"]
+      self.delete(("interfaces", "interface-range", name))
+      for member in members:
+        inherited = [p for p in settings if not self.__overridden(("interfaces", member) + p)]
+        for path in inherited:
+          self.set(("interfaces", member) + path)
+
+
+  ## Whether the statement is configured otherwise already: another value of a single-valued statement or list, or
+  ## another flag of the same exclusive set
+  def __overridden(self, path):
+    parent = self.__node(path[:-1])
+    if parent is None:
+      return False
+    if len(path) >= 2 and path[-2] in SINGLE_VALUED | LEAF_LISTS:
+      return any(t is not MARK for t in parent)
+    for flags in EXCLUSIVE:
+      if path[-1] in flags and any(flag in parent for flag in flags - {path[-1]}):
+        return True
+    return False
+
+
+  def paths(self, node=None, path=()):
+    node = self.root if node is None else node
+    if node.get(MARK):
+      yield path
+    for token, child in node.items():
+      if token is not MARK:
+        yield from self.paths(child, path + (token,))
+
+
+## Commands turning the current configuration into the target: the topmost statement of each subtree that is gone is
+## deleted, unless a new value of a single-valued statement replaces it, and then the statements missing are set.
+def diff_trees(current, target):
+  ## Deactivated statements the target has as active are deleted and set again, as the rendered commands do
+  reactivated = []
+  for path in sorted(current.inactive - target.inactive):
+    if path in target and not any(path[:len(p)] == p for p in reactivated):
+      reactivated.append(path)
+  if reactivated:
+    current = ConfigTree(current.paths(), current.inactive)
+    for path in reactivated:
+      current.delete(path)
+
+  deletes, sets = list(reactivated), []
+
+  def walk_deletes(cur, tgt, path):
+    for token, child in cur.items():
+      if token is MARK:
+        continue
+      if token not in tgt:
+        if not (path and path[-1] in SINGLE_VALUED and any(t is not MARK for t in tgt)):
+          deletes.append(path + (token,))
+        continue
+      walk_deletes(child, tgt[token], path + (token,))
+
+  def walk_sets(cur, tgt, path):
+    for token, child in tgt.items():
+      if token is MARK:
+        continue
+      if cur is None or token not in cur:
+        sets.extend(target.paths(child, path + (token,)))
+        continue
+      walk_sets(cur[token], child, path + (token,))
+
+  walk_deletes(current.root, target.root, ())
+  walk_sets(current.root, target.root, ())
+  return [" ".join(["delete"] + [quote(t) for t in p]) for p in deletes] + \
+         [" ".join(["set"] + [quote(t) for t in p]) for p in sets]
+
+
+## Minimal set and delete commands bringing the current configuration to what the rendered commands would make of it
+def delta_commands(rendered, current_config):
+  inactive = set()
+  paths = parse_config(current_config, inactive)
+  current = ConfigTree(paths, inactive)
+  target = ConfigTree(paths, inactive)
+  target.expand_ranges()  # The rendered commands know nothing of the ranges, so the settings go back to each member
+  target.apply(rendered.splitlines())
+  return diff_trees(current, target)
+
+
+## Joins the values of each list given one by one into brackets, e.g., "vlan members [ 110 120 ]". Only runs of "set"
+## are joined, so that no value moves across a "delete".
+def join_leaf_lists(lines):
+  compacted, lists = [], {}
+  for line in lines:
+    command, words = parse_command(line)
+    if command != "set":
+      lists = {}
+    elif len(words) >= 2 and words[-2] in LEAF_LISTS and "[" not in words:
+      key = tuple(words[:-1])
+      if key in lists:
+        lists[key].append(words[-1])
+        continue
+      lists[key] = [words[-1]]
+      compacted.append((key, lists[key]))
+      continue
+    compacted.append(line)
+  return [entry if isinstance(entry, str) else joined_command(*entry) for entry in compacted]
+
+
+def joined_command(key, values):
+  values = [quote(v) for v in values]
+  return " ".join(["set"] + [quote(w) for w in key] + (["["] + values + ["]"] if len(values) > 1 else values))
+
+
+## Commands deleting the interface ranges generated last time, found in the current configuration. The rendered
+## commands know nothing of the ranges, which would otherwise keep their settings on the members.
+def generated_range_deletes(current):
+  ranges = current.root.get("interfaces", {}).get("interface-range", {})
+  return [f"delete interfaces interface-range {quote(name)}" for name in ranges
+          if name is not MARK and name.startswith(RANGE_PREFIX)]
+
+
+## Moves the physical interfaces of the same settings into an interface range each, e.g., dozens of access ports of
+## one VLAN, if it saves commands. Only interfaces deleted as a whole before being set are moved, as the statements
+## left on an interface would take precedence over the range; those deleted again after being set are left as they
+## are too. The ranges generated previously, found in the current configuration, are deleted first, as nothing else
+## would remove a member from them.
+def group_interfaces(lines, current=None):
+  settings, positions, cleared, deleted = {}, {}, set(), set()
+  for n, line in enumerate(lines):
+    command, words = parse_command(line)
+    if len(words) < 2 or words[0] != "interfaces" or not PHYSICAL_INTERFACE.match(words[1]):
+      continue
+    if command == "delete" and words[1] in settings:
+      deleted.add(words[1])
+    elif command == "delete" and len(words) == 2:
+      cleared.add(words[1])
+    elif command == "set" and len(words) > 2:
+      settings.setdefault(words[1], []).append(line.split(None, 3)[3])  # As written, e.g., with the brackets
+      positions.setdefault(words[1], []).append(n)
+
+  groups = {}
+  for interface, statements in settings.items():
+    if interface in cleared and interface not in deleted:
+      groups.setdefault(tuple(statements), []).append(interface)
+  groups = [(statements, members) for statements, members in groups.items()
+            if len(members) * len(statements) > len(members) + len(statements)]
+
+  moved, inserted = set(), {}
+  for n, (statements, members) in enumerate(groups, start=1):
+    name = f"{RANGE_PREFIX}{n}"
+    inserted[positions[members[0]][0]] = [f"set interfaces interface-range {name} member {m}" for m in members] + \
+                                         [f"set interfaces interface-range {name} {s}" for s in statements]
+    moved.update(i for m in members for i in positions[m])
+
+  stale = generated_range_deletes(current) if current is not None else []
+
+  compacted = list(stale)
+  for n, line in enumerate(lines):
+    compacted.extend(inserted.get(n, []))
+    if n not in moved:
+      compacted.append(line)
+  return compacted
+
+
+## Fewer commands doing the same as the rendered ones. Interface ranges are generated only with the current configuration,
+## where the ranges generated last time are found. The result is checked by expanding both into the configuration they
+## make of the current one, and the rendered commands are returned as they are if the two differ. Commands from
+## delta_commands() (ranges=False) take care of the current ranges by themselves, so they are applied as they are.
+def compact_commands(commands, current_config=None, ranges=True):
+  lines = [line.strip() for line in commands if line.strip()]
+  paths = parse_config(current_config) if current_config else []
+  compacted = join_leaf_lists(lines)
+  if ranges and current_config:
+    compacted = group_interfaces(compacted, ConfigTree(paths))
+
+  expected, actual = ConfigTree(paths), ConfigTree(paths)
+  if ranges:
+    expected.expand_ranges()
+  expected.apply(lines)
+  expected.expand_ranges()
+  actual.apply(compacted)
+  actual.expand_ranges()
+  if sorted(expected.paths()) != sorted(actual.paths()):
+    print("Compacted commands differ from the rendered ones; left as they are", file=sys.stderr)
+    return lines
+  return compacted
+
+
+## Latest snapshot of the host taken by the playbooks: "_after.cfg" of the last run, or "_before.cfg" if it failed
+def latest_backup(hostname, backup_dirs=BACKUP_DIRS):
+  for backup_dir in sorted(glob.glob(backup_dirs), reverse=True):
+    for suffix in ["after", "before"]:
+      path = os.path.join(backup_dir, f"{hostname}_{suffix}.cfg")
+      if os.path.exists(path):
+        return path
+  return None
+
+
+def main():
+  parser = argparse.ArgumentParser(description="optimize rendered junos set commands against the current configuration")
+  parser.add_argument("-r", "--rendered", required=True, dest="RENDERED_PATH", help="path of the rendered set commands")
+  parser.add_argument("-c", "--current", required=False, dest="CURRENT_PATH", help="path of the current configuration, in either text or set format")
+  parser.add_argument("--delta", action="store_true", help="print the commands needed on top of the current configuration only")
+  parser.add_argument("--compact", action="store_true", help="join vlan members into brackets, and ports of the same settings into interface ranges")
+  args = parser.parse_args()
+
+  with open(args.RENDERED_PATH) as fd:
+    rendered = fd.read()
+  current_config = None
+  if args.CURRENT_PATH is not None:
+    with open(args.CURRENT_PATH) as fd:
+      current_config = fd.read()
+  if args.delta and current_config is None:
+    parser.error("--delta requires -c/--current")
+
+  commands = rendered.splitlines()
+  if args.delta:
+    commands = delta_commands(rendered, current_config)
+  if args.compact:
+    commands = compact_commands(commands, current_config, ranges=not args.delta)
+  print("\n".join(commands))
+
+if __name__ == "__main__":
+  main()
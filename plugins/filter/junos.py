@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# This file is part of Ansible.
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import sys
+
+CURDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../..")
+sys.path.append(CURDIR)
+
+from junoscfg import ConfigTree, compact_commands, delta_commands, generated_range_deletes, parse_config
+
+
+## e.g., lines: "{{ lookup('template', 'interface_edge.cfg.j2') | junos_delta(lookup('file', before_cfg)) }}"
+## Without the current configuration, the rendered commands are passed as they are.
+def junos_delta(rendered, current_config=None):
+  if not current_config:
+    return [line for line in rendered.splitlines() if line.strip()]
+  return delta_commands(rendered, current_config)
+
+
+## e.g., lines: "{{ commands | junos_compact(lookup('file', before_cfg)) }}"
+## Ports are grouped into interface ranges only with the current configuration; pass ranges=false after junos_delta.
+def junos_compact(commands, current_config=None, ranges=True):
+  if isinstance(commands, str):
+    commands = commands.splitlines()
+  return compact_commands(commands, current_config or None, ranges=ranges)
+
+
+## e.g., lines: "{{ before | junos_range_deletes + lookup('template', 'interface_edge.cfg.j2').splitlines() }}"
+## Commands deleting the interface ranges generated by junos_compact, if the current configuration has any.
+def junos_range_deletes(current_config=None):
+  if not current_config:
+    return []
+  return generated_range_deletes(ConfigTree(parse_config(current_config)))
+
+
+class FilterModule:
+  def filters(self):
+    return {
+      "junos_delta":         junos_delta,
+      "junos_compact":       junos_compact,
+      "junos_range_deletes": junos_range_deletes,
+    }
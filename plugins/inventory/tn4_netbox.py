@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# This file is part of Ansible.
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r"""
+  name: tn4_netbox
+  plugin_type: inventory
+  short_description: Titanet4 switches managed in NetBox
+  description:
+    - Builds the same inventory as C(inventories/production/netbox.py) inside the Ansible process.
+    - The inventory is stored in the inventory cache, so that subsequent runs within the timeout skip NetBox.
+    - The C(datetime) hostvar and the C(CHANGED) group are renewed on every run, even if the rest comes from the cache.
+  extends_documentation_fragment:
+    - inventory_cache
+  options:
+    plugin:
+      description: Token that ensures this is a source file for the plugin.
+      required: true
+      choices: ["tn4_netbox"]
+    limit:
+      description:
+        - Build the matching hosts only, in the syntax of C(ansible-playbook --limit).
+        - Ansible never passes its limit to inventory plugins, so give both.
+      type: str
+      env:
+        - name: NETBOX_LIMIT
+"""
+
+EXAMPLES = r"""
+# inventories/production/netbox.yml
+plugin: tn4_netbox
+cache: true
+cache_plugin: jsonfile
+cache_connection: .cache/inventory
+cache_timeout: 300
+"""
+
+import os
+import sys
+
+from ansible.plugins.inventory import BaseInventoryPlugin, Cacheable
+
+INVENTORYDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../inventories/production")
+sys.path.append(INVENTORYDIR)
+
+from netbox import CHANGED_GROUP, changed_hosts, dynamic_inventory, timestamp
+
+
+class InventoryModule(BaseInventoryPlugin, Cacheable):
+  NAME = "tn4_netbox"
+
+
+  def verify_file(self, path):
+    return super().verify_file(path) and path.endswith(("netbox.yml", "netbox.yaml"))
+
+
+  def parse(self, inventory, loader, path, cache=True):
+    super().parse(inventory, loader, path, cache=cache)
+    self._read_config_data(path)
+
+    limit = self.get_option("limit")
+    cache_key = self.get_cache_key(f"{path}:{limit}")
+    use_cache = self.get_option("cache") and cache  # "--flush-cache" turns it off
+    update_cache = self.get_option("cache") and not cache
+
+    source = None
+    if use_cache:
+      try:
+        source = self._cache[cache_key]
+      except KeyError:
+        update_cache = True
+
+    if source is None:
+      source = dynamic_inventory(limit=limit, daemon=cache)  # Flushing skips the inventory daemon as well
+    if update_cache:
+      self._cache[cache_key] = source
+
+    self.__populate(source)
+
+
+  def __populate(self, source):
+    ## Backups are stored by the datetime, which must not be shared with the run that filled the cache
+    ts = timestamp()
+
+    ## Neither must the hosts to deploy, as the cache outlives the deployments recording their intents
+    source = {**source, CHANGED_GROUP: {"hosts": changed_hosts(source["_meta"]["hostvars"])}}
+
+    for group, members in source.items():
+      if group == "_meta":
+        continue
+      self.inventory.add_group(group)
+      for hostname in members.get("hosts", []):
+        self.inventory.add_host(hostname, group=group)
+      for key, value in members.get("vars", {}).items():
+        self.inventory.set_variable(group, key, value)  # e.g., the VLAN catalog
+
+    for hostname, hostvars in source["_meta"]["hostvars"].items():
+      self.inventory.add_host(hostname)
+      for key, value in hostvars.items():
+        self.inventory.set_variable(hostname, key, value)
+      self.inventory.set_variable(hostname, "datetime", ts)
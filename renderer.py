@@ -1,88 +1,271 @@
 #!/usr/bin/env python3
 
+from concurrent.futures import ProcessPoolExecutor
 from pprint import pprint
 import argparse
+import hashlib
 import jinja2
+import json
 import os
 import sys
+import tempfile
 import time
+import yaml
 
 CURDIR = os.path.dirname(os.path.abspath(__file__))
 INVENTORYDIR = os.path.join(CURDIR, "inventories/production")
 sys.path.append(INVENTORYDIR)
 
-from netbox import dynamic_inventory
+from netbox import dynamic_inventory, limit_inventory, NETBOX_LIMIT
+from templating import load_template, template_inputs
+from junoscfg import compact_commands, delta_commands, latest_backup
 
+## Templates given by name, or not given at all, are looked up in the role of the manufacturer of each host
+ROLE_TEMPLATE_PATH = "roles/{manufacturer}/templates/{tpl_name}"
+DEFAULT_TEMPLATE_NAME = "interface_{role}.cfg.j2"  # e.g., interface_edge.cfg.j2 for EDGE-SW
+RENDER_INDEX = ".renderer.json"  # Digests of the configs in the output directory
+
+
+def load_inventories(refresh=False, limit=None, path=None):
+  if path is not None:
+    with open(path) as fd:
+      return limit_inventory(json.load(fd), limit)  # Written by "netbox.py -o"
 
-def load_inventories():
   start_at = time.time()
   print("Loading inventories from NetBox, this may take a while...", end=" ", flush=True)
-  inventories = dynamic_inventory()
+  inventories = dynamic_inventory(refresh=refresh, limit=limit)
   elapsed_time = round(time.time() - start_at, 1)
   print(f"completed successfully ({elapsed_time}sec)", flush=True)
   return inventories
 
 
-def render_templates(tpl_path, device_role, inventories, manufacturer=None, trim_blocks=False):
-  loader_base = os.path.join(CURDIR, os.path.dirname(tpl_path))
-  tpl_name = os.path.basename(tpl_path)
-  env = jinja2.Environment(loader=jinja2.FileSystemLoader(loader_base), trim_blocks=trim_blocks)
+def ignore_empty_lines(s):
+  return "\n".join([l for l in s.split("\n") if l != ""])
+
+
+## Each worker compiles the template once, and receives the hostvars only; the group vars of "all" come with it
+RENDER_WORKER = {}
+
 
+def init_render_worker(tpl_path, trim_blocks, all_vars):
+  RENDER_WORKER.update(template=load_template(tpl_path, trim_blocks), all_vars=all_vars)
+
+
+def render_host(hostvars):
   try:
-    template = env.get_template(tpl_name)
-  except jinja2.exceptions.TemplateNotFound:
-    print(f"No such template: {tpl_path}", file=sys.stderr)
-    sys.exit(1)
+    raw = RENDER_WORKER["template"].render({**RENDER_WORKER["all_vars"], **hostvars})
+  except Exception as e:
+    return None, str(e)  # Exceptions of Jinja do not always survive pickling
+  return ignore_empty_lines(raw), None
+
+
+def iter_rendered(tpl_path, all_hostvars, all_vars, trim_blocks=False, jobs=1):
+  jobs = jobs or os.cpu_count() or 1
+  jobs = min(jobs, len(all_hostvars))
+  initargs = (tpl_path, trim_blocks, all_vars)
+  if jobs < 2:
+    init_render_worker(*initargs)
+    yield from map(render_host, all_hostvars)
+    return
+
+  with ProcessPoolExecutor(jobs, initializer=init_render_worker, initargs=initargs) as pool:
+    chunksize = max(1, len(all_hostvars) // (jobs * 4))
+    yield from pool.map(render_host, all_hostvars, chunksize=chunksize)  # Results keep the order of the hosts
 
+
+def select_template(tpl_path, device_role, manufacturer):
+  if tpl_path is None:
+    tpl_path = DEFAULT_TEMPLATE_NAME.format(role=device_role.split("-")[0].lower())
+  if os.path.dirname(tpl_path) == "":
+    tpl_path = ROLE_TEMPLATE_PATH.format(manufacturer=manufacturer, tpl_name=tpl_path)
+  return tpl_path
+
+
+def value_hash(value):
+  return hashlib.sha256(json.dumps(value).encode()).hexdigest()  # Keys are not sorted; their order reaches the configs
+
+
+## Digest of everything a render depends on: the template, and the params it reads. The group vars of "all" are
+## shared by the hosts, so they are hashed once per template.
+class RenderDigest:
+  def __init__(self, tpl_path, all_vars, trim_blocks=False):
+    self.tpl_hash, self.names = template_inputs(tpl_path)
+    self.trim_blocks = trim_blocks
+    self.shared = {name: value_hash(all_vars[name]) for name in self.names if name in all_vars}
+
+
+  def digest(self, hostvars):
+    params = [[name, value_hash(hostvars[name]) if name in hostvars else self.shared.get(name)] for name in self.names]
+    return value_hash([self.tpl_hash, self.trim_blocks, params])
+
+
+def load_render_index(output_dir):
+  try:
+    with open(os.path.join(output_dir, RENDER_INDEX)) as fd:
+      index = json.load(fd)
+  except (OSError, ValueError):
+    return {}
+  return {h: digest for h, digest in index.items() if os.path.exists(os.path.join(output_dir, f"{h}.cfg"))}
+
+
+## Temporary files are created owner-only; the configs get the mode open() would give them, i.e., by the umask
+def write_atomically(path, content):
+  umask = os.umask(0)
+  os.umask(umask)
+  with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path) or ".", suffix=".tmp", delete=False) as fd:
+    fd.write(content)
+  os.chmod(fd.name, 0o666 & ~umask)
+  os.replace(fd.name, path)
+
+
+def render_templates(tpl_path, device_role, inventories, manufacturer=None, trim_blocks=False, jobs=1, index=None):
+  ## With the index of the last run, hosts of the same digest are skipped, and the index gets the digests rendered
   try:
     hostnames = inventories[device_role]["hosts"]
   except KeyError:
     print(f"No such device role: {device_role}", file=sys.stderr)
     sys.exit(2)
 
-  results = {}
-  for hostname in hostnames:
-    params = inventories["_meta"]["hostvars"][hostname]
-    if manufacturer is not None:
-      if params["manufacturer"] != manufacturer:
-        continue
+  all_hostvars = {hostname: inventories["_meta"]["hostvars"][hostname] for hostname in hostnames}
+  if manufacturer is not None:
+    all_hostvars = {h: hostvars for h, hostvars in all_hostvars.items() if hostvars["manufacturer"] == manufacturer}
+
+  tpl_paths = {h: select_template(tpl_path, device_role, hostvars["manufacturer"]) for h, hostvars in all_hostvars.items()}
+  for path in dict.fromkeys(tpl_paths.values()):
     try:
-      ip = params["ansible_host"]
+      load_template(path, trim_blocks)
+    except jinja2.exceptions.TemplateNotFound:
+      print(f"No such template: {path}", file=sys.stderr)
+      sys.exit(1)
+
+  all_vars = inventories.get("all", {}).get("vars", {})  # e.g., the VLAN catalog
+
+  if index is not None:
+    digests = {path: RenderDigest(path, all_vars, trim_blocks=trim_blocks) for path in dict.fromkeys(tpl_paths.values())}
+    digests = {h: digests[tpl_paths[h]].digest(hostvars) for h, hostvars in all_hostvars.items()}
+    all_hostvars = {h: hostvars for h, hostvars in all_hostvars.items() if index.get(h) != digests[h]}
+    index.update({h: digests[h] for h in all_hostvars})
+
+  rendered = {}
+  for path in dict.fromkeys(tpl_paths[h] for h in all_hostvars):
+    targets = {h: hostvars for h, hostvars in all_hostvars.items() if tpl_paths[h] == path}
+    results = iter_rendered(path, list(targets.values()), all_vars, trim_blocks=trim_blocks, jobs=jobs)
+    for (hostname, hostvars), (result, error) in zip(targets.items(), results):
+      ip = hostvars["ansible_host"]
       host = f"{hostname} ({ip})"
-      raw = template.render(params)
-    except Exception as e:
-      print(f"An error occurred while rendering {host}. Aborted: {e}", file=sys.stderr)
-      sys.exit(4)
-    else:
-      ignore_empty_lines = lambda s: "\n".join([l for l in s.split("\n") if l != ""])
-      results[host] = ignore_empty_lines(raw)
+      if error is not None:
+        print(f"An error occurred while rendering {host}. Aborted: {error}", file=sys.stderr)
+        sys.exit(4)
+      rendered[hostname] = host, result
 
-  return results
+  return dict(rendered[hostname] for hostname in all_hostvars)  # In the order of the inventory
+
+
+## Turns the configs of the Juniper hosts into the commands needed on top of their latest backup, and/or compacts them
+def junos_results(results, inventories, delta=False, compact=False):
+  optimized = {}
+  for host, result in results.items():
+    hostname = host.split()[0]
+    if inventories["_meta"]["hostvars"][hostname]["manufacturer"] != "juniper":
+      optimized[host] = result
+      continue
+
+    current_config = None
+    backup_path = latest_backup(hostname)
+    if backup_path is not None:
+      with open(backup_path) as fd:
+        current_config = fd.read()
+
+    commands = result.splitlines()
+    if delta and current_config is None:
+      print(f"No backup of {hostname} to take the delta from; rendered in full", file=sys.stderr)
+    elif delta:
+      commands = delta_commands(result, current_config)
+    if compact:
+      commands = compact_commands(commands, current_config, ranges=not delta)
+    optimized[host] = "\n".join(commands)
+  return optimized
+
+
+## List of the targets to render from one inventory, e.g.:
+##   - role: edge-sw                      # The template of each host by its manufacturer
+##   - role: core-sw
+##     manufacturer: juniper
+##     template: overwrite.cfg.j2         # Looked up in roles/juniper/templates
+##     output: overwrite                  # Under the directory given by -o
+def load_manifest(path):
+  with open(path) as fd:
+    targets = yaml.safe_load(fd) or []
+  for target in targets:
+    if "role" not in target:
+      print(f"No device role in the target of {path}: {target}", file=sys.stderr)
+      sys.exit(3)
+  return targets
 
 
 def main():
   parser = argparse.ArgumentParser(description="rendering config template reflecting NetBox database")
-  parser.add_argument("-t", "--template", required=True, dest="PATH", help="path of the template from (e.g., ./roles/juniper/templates/overwrite.cfg.j2)")
-  parser.add_argument("-d", "--device-role", required=True, dest="ROLE", help="device role (e.g., edge-sw)")
+  parser.add_argument("-t", "--template", required=False, dest="PATH", help="path or name of the template (e.g., ./roles/juniper/templates/overwrite.cfg.j2 or overwrite.cfg.j2), interface_<role>.cfg.j2 of the manufacturer if omitted")
+  parser.add_argument("-d", "--device-role", required=False, dest="ROLE", help="device role (e.g., edge-sw)")
+  parser.add_argument("-f", "--manifest", required=False, dest="MANIFEST_PATH", help="render all targets listed in the yaml file with one inventory, instead of -t, -d and -m")
   parser.add_argument("-m", "--manufacturer", required=False, dest="VENDOR", help="manufacturer (e.g., juniper)")
   parser.add_argument("-o", "--output", required=False, dest="DIR_PATH", help="save rendered config if specified")
+  parser.add_argument("-l", "--limit", required=False, dest="PATTERN", default=NETBOX_LIMIT, help="render the matching hosts only (e.g., minami3 or suzukake)")
+  parser.add_argument("-i", "--inventory", required=False, dest="FILE_PATH", help="load the inventory from the file written by netbox.py -o instead of NetBox")
+  parser.add_argument("-j", "--jobs", type=int, dest="N", default=1, help="render the hosts on N processes, 0 for all cores (default: 1)")
+  parser.add_argument("--delta", action="store_true", help="render the junos commands needed on top of the latest backup/juniper_config.* only")
+  parser.add_argument("--compact", action="store_true", help="join the vlan members of the junos commands into brackets, and ports of the same settings into interface ranges")
+  parser.add_argument("--incremental", action="store_true", help="with -o, skip the hosts whose template and params are the same as the last run")
+  parser.add_argument("--refresh", action="store_true", help="ignore the NetBox snapshot cache and fetch everything again")
   args = parser.parse_args()
 
-  tpl_path = args.PATH
-  device_role = args.ROLE.upper()
-  manufacturer = args.VENDOR
-  output_dir = args.DIR_PATH
-  inventories = load_inventories()
+  if args.MANIFEST_PATH is not None:
+    targets = load_manifest(args.MANIFEST_PATH)
+  elif args.ROLE is not None:
+    targets = [{"template": args.PATH, "role": args.ROLE, "manufacturer": args.VENDOR}]
+  else:
+    parser.error("either -d/--device-role or -f/--manifest is required")
+  if args.incremental and args.DIR_PATH is None:
+    parser.error("--incremental requires -o/--output")
+  if args.incremental and (args.delta or args.compact):
+    parser.error("--incremental cannot tell when the backups change; drop it with --delta and --compact")
 
-  results = render_templates(tpl_path, device_role, inventories, manufacturer=manufacturer)
-  for host, result in results.items():
-    print("\n".join([":"*25, host, ":"*25, result]), end="\n"*2)
-    if output_dir is not None:
-      output_dir = output_dir.rstrip("/")
-      hostname = host.split()[0]
-      with open(f"{output_dir}/{hostname}.cfg", "w") as fd:
-        fd.write(result)
+  inventories = load_inventories(refresh=args.refresh, limit=args.PATTERN, path=args.FILE_PATH)
+
+  written = set()
+  indices = {}
+  n_rendered = 0
+  for target in targets:
+    device_role = target["role"].upper()
+    output_dir = args.DIR_PATH
+    if output_dir is not None and target.get("output") is not None:
+      output_dir = os.path.join(output_dir, target["output"])
+      os.makedirs(output_dir, exist_ok=True)
+
+    index = None
+    if args.incremental:
+      index = indices.setdefault(output_dir.rstrip("/"), load_render_index(output_dir))
+    results = render_templates(target.get("template"), device_role, inventories, manufacturer=target.get("manufacturer"), jobs=args.N, index=index)
+    n_rendered += len(results)
+    if args.delta or args.compact:
+      results = junos_results(results, inventories, delta=args.delta, compact=args.compact)
+
+    for host, result in results.items():
+      print("\n".join([":"*25, host, ":"*25, result]), end="\n"*2)
+      if output_dir is not None:
+        output_dir = output_dir.rstrip("/")
+        hostname = host.split()[0]
+        output_path = f"{output_dir}/{hostname}.cfg"
+        if output_path in written:
+          print(f"{hostname} is rendered by more than one target to {output_dir}; give each an output", file=sys.stderr)
+          sys.exit(3)
+        written.add(output_path)
+        write_atomically(output_path, result)
 
+  for output_dir, index in indices.items():
+    write_atomically(os.path.join(output_dir, RENDER_INDEX), json.dumps(index, indent=2))
+  if args.incremental:
+    print(f"Rendered {n_rendered} hosts; the others are unchanged since the last run", file=sys.stderr)
 
 if __name__ == "__main__":
   main()
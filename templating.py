@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+from jinja2.bccache import Bucket
+import argparse
+import glob
+import hashlib
+import jinja2
+import jinja2.meta
+import json
+import os
+import tempfile
+
+CURDIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIRS = os.path.join(CURDIR, "roles/*/templates")
+TEMPLATE_CACHE_DIR = os.getenv("TEMPLATE_CACHE_DIR", os.path.join(CURDIR, ".cache/jinja"))  # Empty to disable
+TEMPLATE_MODULE_DIR = os.getenv("TEMPLATE_MODULE_DIR", os.path.join(CURDIR, ".cache/templates"))
+
+
+## Options changing the code generated from the same source
+def environment_options(env):
+  return [
+    env.block_start_string, env.block_end_string,
+    env.variable_start_string, env.variable_end_string,
+    env.comment_start_string, env.comment_end_string,
+    env.line_statement_prefix, env.line_comment_prefix,
+    env.trim_blocks, env.lstrip_blocks, env.newline_sequence, env.keep_trailing_newline,
+  ]
+
+
+def source_hash(source):
+  return hashlib.sha256(source.encode()).hexdigest()
+
+
+## Bytecode is keyed by the source and the options of the environment rather than the name, so that an edited template
+## or another "trim_blocks" never loads stale code. Jinja writes each file atomically, so workers can share the directory.
+class SourceBytecodeCache(jinja2.FileSystemBytecodeCache):
+  def __init__(self, directory=TEMPLATE_CACHE_DIR):
+    os.makedirs(directory, exist_ok=True)
+    super().__init__(directory, pattern="%s.jinja")
+
+
+  def get_bucket(self, environment, name, filename, source):
+    key = json.dumps([name, environment_options(environment), source_hash(source)])
+    bucket = Bucket(environment, hashlib.sha256(key.encode()).hexdigest(), self.get_source_checksum(source))
+    self.load_bytecode(bucket)
+    return bucket
+
+
+## Precompiled modules live in one directory per template directory and options, along with the hashes of the sources
+## they were compiled from. Any source added, removed or edited since makes the whole directory stale.
+def module_dir(tpl_dir, env):
+  key = json.dumps([os.path.abspath(tpl_dir), environment_options(env)])
+  return os.path.join(TEMPLATE_MODULE_DIR, hashlib.sha256(key.encode()).hexdigest()[:16])
+
+
+def template_sources(loader, env):
+  return {name: source_hash(loader.get_source(env, name)[0]) for name in loader.list_templates()}
+
+
+def precompiled_loader(tpl_dir, env):
+  path = module_dir(tpl_dir, env)
+  try:
+    with open(os.path.join(path, "sources.json")) as fd:
+      sources = json.load(fd)
+  except (OSError, ValueError):
+    return None
+  if sources != template_sources(jinja2.FileSystemLoader(tpl_dir), env):
+    return None
+  return jinja2.ModuleLoader(path)
+
+
+def precompile(tpl_dir, trim_blocks=False):
+  env = jinja2.Environment(loader=jinja2.FileSystemLoader(tpl_dir), trim_blocks=trim_blocks)
+  path = module_dir(tpl_dir, env)
+  os.makedirs(path, exist_ok=True)
+  sources = template_sources(env.loader, env)
+  env.compile_templates(path, zip=None, ignore_errors=False)
+
+  ## Written last, so that an interrupted run leaves the modules stale rather than half-done
+  with tempfile.NamedTemporaryFile("w", dir=path, suffix=".tmp", delete=False) as fd:
+    json.dump(sources, fd)
+  os.replace(fd.name, os.path.join(path, "sources.json"))
+  return path
+
+
+def template_environment(tpl_dir, trim_blocks=False):
+  env = jinja2.Environment(trim_blocks=trim_blocks)
+  env.loader = precompiled_loader(tpl_dir, env)
+  if env.loader is None:
+    env.loader = jinja2.FileSystemLoader(tpl_dir)
+    if TEMPLATE_CACHE_DIR:
+      env.bytecode_cache = SourceBytecodeCache(TEMPLATE_CACHE_DIR)
+  return env
+
+
+def load_template(tpl_path, trim_blocks=False):
+  tpl_dir = os.path.join(CURDIR, os.path.dirname(tpl_path))
+  tpl_name = os.path.basename(tpl_path)
+  return template_environment(tpl_dir, trim_blocks=trim_blocks).get_template(tpl_name)
+
+
+## Hash of the source and the names a template reads from its context, e.g., to tell whether a render would change.
+## Templates included or imported from it are not followed; none of the roles does so.
+def template_inputs(tpl_path):
+  with open(os.path.join(CURDIR, tpl_path)) as fd:
+    source = fd.read()
+  names = jinja2.meta.find_undeclared_variables(jinja2.Environment().parse(source))
+  return source_hash(source), sorted(names)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="precompile the templates of all roles into python modules")
+  parser.add_argument("-d", "--template-dir", dest="DIR_PATH", action="append", help="directory of the templates (default: roles/*/templates)")
+  args = parser.parse_args()
+
+  for tpl_dir in args.DIR_PATH or sorted(glob.glob(TEMPLATE_DIRS)):
+    for trim_blocks in [False, True]:
+      path = precompile(tpl_dir, trim_blocks=trim_blocks)
+      print(f"Precompiled {os.path.relpath(tpl_dir, CURDIR)} (trim_blocks={trim_blocks}) into {os.path.relpath(path, CURDIR)}")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+from unittest import mock
+import os
+import sys
+import unittest
+
+CURDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(CURDIR)
+sys.path.append(os.path.join(CURDIR, "plugins/filter"))
+
+import junoscfg
+from junoscfg import ConfigTree, compact_commands, delta_commands, diff_trees, parse_config
+from junos import junos_delta
+
+CURRENT_TEXT = """
+## Last commit: 2021-08-01 00:00:00 JST by ansible
+interfaces {
+    ge-0/0/1 {
+        description "to room 101";
+        unit 0 {
+            family ethernet-switching {
+                interface-mode access;
+                vlan {
+                    members 110;
+                }
+            }
+        }
+    }
+    ge-0/0/2 {
+        disable;
+        unit 0 {
+            family ethernet-switching {
+                interface-mode trunk;
+                vlan {
+                    members [ 120 130 ];
+                }
+            }
+        }
+    }
+}
+vlans {
+    "lab vlan" {
+        vlan-id 110;
+    }
+}
+"""
+
+CURRENT_SET = """
+set interfaces ge-0/0/1 description "to room 101"
+set interfaces ge-0/0/1 unit 0 family ethernet-switching interface-mode access
+set interfaces ge-0/0/1 unit 0 family ethernet-switching vlan members 110
+set interfaces ge-0/0/2 disable
+set interfaces ge-0/0/2 unit 0 family ethernet-switching interface-mode trunk
+set interfaces ge-0/0/2 unit 0 family ethernet-switching vlan members 120
+set interfaces ge-0/0/2 unit 0 family ethernet-switching vlan members 130
+set vlans "lab vlan" vlan-id 110
+"""
+
+## What the templates render for the current configuration: every interface is deleted and set again
+RENDERED = """
+delete vlans
+delete interfaces ge-0/0/1
+delete interfaces ge-0/0/2
+set vlans "lab vlan" vlan-id 110
+set interfaces ge-0/0/1 description "to room 101"
+set interfaces ge-0/0/1 unit 0 family ethernet-switching interface-mode access
+set interfaces ge-0/0/1 unit 0 family ethernet-switching vlan members 110
+set interfaces ge-0/0/2 disable
+set interfaces ge-0/0/2 unit 0 family ethernet-switching interface-mode trunk
+set interfaces ge-0/0/2 unit 0 family ethernet-switching vlan members 120
+set interfaces ge-0/0/2 unit 0 family ethernet-switching vlan members 130
+"""
+
+
+## Access ports deleted and set again, and uplinks which the templates never delete (skip_delete)
+UPLINKS_CURRENT = "\n".join(
+  [f"set interfaces ge-0/0/{n} {s}" for n in [0, 1] for s in [
+    "disable", 'description "old uplink"',
+    "unit 0 family ethernet-switching interface-mode access", "unit 0 family ethernet-switching vlan members 110",
+  ]] + [f"set interfaces ge-0/0/{n} unit 0 family ethernet-switching vlan members 110" for n in range(2, 6)]
+)
+
+UPLINKS_RENDERED = [f"set interfaces ge-0/0/{n} {s}" for n in [0, 1] for s in [
+  "enable", "unit 0 family ethernet-switching interface-mode trunk", "unit 0 family ethernet-switching vlan members all",
+]]
+for n in range(2, 6):
+  UPLINKS_RENDERED += [f"delete interfaces ge-0/0/{n}"] + [f"set interfaces ge-0/0/{n} {s}" for s in [
+    "enable", "unit 0 family ethernet-switching interface-mode access", "unit 0 family ethernet-switching vlan members 120",
+  ]]
+
+
+def deployed(current_config, commands):
+  inactive = set()
+  tree = ConfigTree(parse_config(current_config, inactive), inactive)
+  tree.apply(commands)
+  return tree
+
+
+def effective(tree):
+  tree = ConfigTree(tree.paths(), tree.inactive)
+  tree.expand_ranges()
+  return sorted(tree.paths())
+
+
+class ParseConfigTest(unittest.TestCase):
+  def test_text_and_set_formats(self):
+    self.assertEqual(sorted(parse_config(CURRENT_TEXT)), sorted(parse_config(CURRENT_SET)))
+
+
+  def test_quoted_names(self):
+    paths = parse_config(CURRENT_TEXT)
+    self.assertIn(("vlans", "lab vlan", "vlan-id", "110"), paths)
+    self.assertIn(("interfaces", "ge-0/0/1", "description", "to room 101"), paths)
+
+
+  def test_bracketed_members(self):
+    paths = parse_config(CURRENT_TEXT)
+    for vid in ["120", "130"]:
+      self.assertIn(("interfaces", "ge-0/0/2", "unit", "0", "family", "ethernet-switching", "vlan", "members", vid), paths)
+
+
+  def test_inactive_statements(self):
+    inactive = set()
+    parse_config("interfaces {\n    inactive: ge-0/0/1 {\n        disable;\n    }\n    ge-0/0/2 {\n"
+                 "        inactive: description foo;\n    }\n}\n", inactive)
+    self.assertEqual(inactive, {("interfaces", "ge-0/0/1"), ("interfaces", "ge-0/0/2", "description", "foo")})
+
+    inactive = set()
+    parse_config("set interfaces ge-0/0/1 disable\ndeactivate interfaces ge-0/0/1\n", inactive)
+    self.assertEqual(inactive, {("interfaces", "ge-0/0/1")})
+
+
+class DeltaCommandsTest(unittest.TestCase):
+  def test_unchanged(self):
+    self.assertEqual(delta_commands(RENDERED, CURRENT_TEXT), [])
+    self.assertEqual(delta_commands(RENDERED, CURRENT_SET), [])
+
+
+  def test_single_leaf(self):
+    rendered = RENDERED.replace("vlan members 110", "vlan members 111")
+    self.assertEqual(delta_commands(rendered, CURRENT_TEXT), [
+      "delete interfaces ge-0/0/1 unit 0 family ethernet-switching vlan members 110",
+      "set interfaces ge-0/0/1 unit 0 family ethernet-switching vlan members 111",
+    ])
+
+
+  def test_single_valued_replacement(self):
+    rendered = RENDERED.replace('description "to room 101"', 'description "to room 102"')
+    self.assertEqual(delta_commands(rendered, CURRENT_TEXT), ['set interfaces ge-0/0/1 description "to room 102"'])
+
+    rendered = RENDERED.replace("interface-mode trunk", "interface-mode access")
+    self.assertEqual(delta_commands(rendered, CURRENT_TEXT), [
+      "set interfaces ge-0/0/2 unit 0 family ethernet-switching interface-mode access",
+    ])
+
+
+  def test_exclusive_replacement(self):
+    rendered = RENDERED.replace("ge-0/0/2 disable", "ge-0/0/2 enable")
+    self.assertEqual(delta_commands(rendered, CURRENT_TEXT), [
+      "delete interfaces ge-0/0/2 disable",
+      "set interfaces ge-0/0/2 enable",
+    ])
+
+
+  def test_removed_statement(self):
+    rendered = "\n".join(l for l in RENDERED.splitlines() if "ge-0/0/1 description" not in l)
+    self.assertEqual(delta_commands(rendered, CURRENT_TEXT), ["delete interfaces ge-0/0/1 description"])
+
+
+  def test_quoted_names(self):
+    rendered = RENDERED.replace('"lab vlan" vlan-id 110', '"lab vlan" vlan-id 112')
+    self.assertEqual(delta_commands(rendered, CURRENT_TEXT), ['set vlans "lab vlan" vlan-id 112'])
+
+
+  def test_inactive_statement_set_again(self):
+    current = CURRENT_TEXT.replace("    ge-0/0/1 {", "    inactive: ge-0/0/1 {")
+    delta = delta_commands(RENDERED, current)
+    self.assertEqual(delta[0], "delete interfaces ge-0/0/1")
+    self.assertIn('set interfaces ge-0/0/1 description "to room 101"', delta)
+
+    ## Deploying the delta ends in the same configuration as the full render, all active
+    self.assertEqual(sorted(deployed(current, delta).paths()), sorted(deployed(current, RENDERED.splitlines()).paths()))
+    self.assertEqual(deployed(current, delta).inactive, set())
+
+
+  def test_inactive_statement_left_alone(self):
+    current = CURRENT_TEXT + "protocols {\n    inactive: lldp {\n        interface all;\n    }\n}\n"
+    self.assertEqual(delta_commands(RENDERED, current), [])
+
+
+  def test_deployed_delta_matches_full_render(self):
+    rendered = RENDERED.replace("members 130", "members 140").replace("ge-0/0/2 disable", "ge-0/0/2 enable")
+    delta = delta_commands(rendered, CURRENT_SET)
+    self.assertEqual(sorted(deployed(CURRENT_SET, delta).paths()),
+                     sorted(deployed(CURRENT_SET, rendered.splitlines()).paths()))
+
+
+  def test_diff_of_identical_trees(self):
+    tree = ConfigTree(parse_config(CURRENT_TEXT))
+    self.assertEqual(diff_trees(tree, ConfigTree(tree.paths())), [])
+
+
+class CompactCommandsTest(unittest.TestCase):
+  def test_members_joined(self):
+    self.assertEqual(compact_commands(RENDERED.splitlines())[-1],
+                     "set interfaces ge-0/0/2 unit 0 family ethernet-switching vlan members [ 120 130 ]")
+
+
+  def test_deleted_interfaces_grouped(self):
+    compacted = compact_commands(UPLINKS_RENDERED, UPLINKS_CURRENT)
+    members = [l.split()[-1] for l in compacted if l.startswith("set interfaces interface-range TN4-1 member ")]
+    self.assertEqual(members, ["ge-0/0/2", "ge-0/0/3", "ge-0/0/4", "ge-0/0/5"])
+    self.assertLess(len(compacted), len(UPLINKS_RENDERED))
+    self.assertEqual(effective(deployed(UPLINKS_CURRENT, compacted)),
+                     effective(deployed(UPLINKS_CURRENT, UPLINKS_RENDERED)))
+
+
+  def test_interfaces_not_deleted_left_alone(self):
+    compacted = compact_commands(UPLINKS_RENDERED, UPLINKS_CURRENT)
+    self.assertFalse([l for l in compacted if "interface-range" in l and l.split()[-1] in ["ge-0/0/0", "ge-0/0/1"]])
+    self.assertIn("set interfaces ge-0/0/0 enable", compacted)
+
+
+  def test_ranges_of_last_run_deleted(self):
+    current = UPLINKS_CURRENT + "\nset interfaces interface-range TN4-1 member ge-0/0/2" + \
+              "\nset interfaces interface-range TN4-1 disable\nset interfaces interface-range ops member ge-0/0/8"
+    compacted = compact_commands(UPLINKS_RENDERED, current)
+    self.assertEqual(compacted[0], "delete interfaces interface-range TN4-1")
+    self.assertNotIn("delete interfaces interface-range ops", compacted)
+
+
+  ## Statements left on a member take precedence over the range, so grouping an interface which is not deleted first
+  ## changes what it ends up with, and the check has to turn it down
+  def test_check_rejects_range_over_member_statements(self):
+    def group_all(lines, current=None):
+      statements = [l.split(None, 3)[3] for l in lines if l.startswith("set interfaces ge-0/0/0 ")]
+      return [f"set interfaces interface-range TN4-1 member ge-0/0/{n}" for n in [0, 1]] + \
+             [f"set interfaces interface-range TN4-1 {s}" for s in statements] + \
+             [l for l in lines if not l.startswith(("set interfaces ge-0/0/0 ", "set interfaces ge-0/0/1 "))]
+
+    with mock.patch.object(junoscfg, "group_interfaces", group_all), mock.patch("sys.stderr"):
+      compacted = compact_commands(UPLINKS_RENDERED, UPLINKS_CURRENT)
+    self.assertEqual(compacted, UPLINKS_RENDERED)
+
+
+  def test_member_statements_take_precedence(self):
+    tree = ConfigTree(parse_config(UPLINKS_CURRENT))
+    tree.apply(["set interfaces interface-range TN4-1 member ge-0/0/0", "set interfaces interface-range TN4-1 enable",
+                'set interfaces interface-range TN4-1 description "new"',
+                "set interfaces interface-range TN4-1 unit 0 family ethernet-switching vlan members all",
+                "set interfaces interface-range TN4-1 mtu 9216"])
+    tree.expand_ranges()
+    paths = [p[2:] for p in tree.paths() if p[:2] == ("interfaces", "ge-0/0/0")]
+    self.assertIn(("disable",), paths)
+    self.assertNotIn(("enable",), paths)
+    self.assertIn(("description", "old uplink"), paths)
+    self.assertIn(("unit", "0", "family", "ethernet-switching", "vlan", "members", "110"), paths)
+    self.assertNotIn(("unit", "0", "family", "ethernet-switching", "vlan", "members", "all"), paths)
+    self.assertIn(("mtu", "9216"), paths)
+
+
+  def test_delta_with_ranges_not_checked_against_expansion(self):
+    current = "\n".join(["set interfaces interface-range TN4-1 member ge-0/0/2",
+                         "set interfaces interface-range TN4-1 member ge-0/0/3",
+                         "set interfaces interface-range TN4-1 unit 0 family ethernet-switching vlan members 110"])
+    rendered = "\n".join(["delete interfaces ge-0/0/2", "delete interfaces ge-0/0/3",
+                          "set interfaces ge-0/0/2 unit 0 family ethernet-switching vlan members 110",
+                          "set interfaces ge-0/0/3 unit 0 family ethernet-switching vlan members 120"])
+    delta = delta_commands(rendered, current)
+    with mock.patch("sys.stderr") as stderr:
+      compacted = compact_commands(delta, current, ranges=False)
+    self.assertFalse(stderr.write.called)
+    self.assertEqual(effective(deployed(current, compacted)), effective(deployed(current, rendered.splitlines())))
+
+
+class DeltaFilterTest(unittest.TestCase):
+  def test_without_current_config(self):
+    self.assertEqual(junos_delta(RENDERED, ""), [l for l in RENDERED.splitlines() if l.strip()])
+
+
+  def test_with_current_config(self):
+    self.assertEqual(junos_delta(RENDERED, CURRENT_TEXT), [])
+
+
+if __name__ == "__main__":
+  unittest.main()